@@ -0,0 +1,83 @@
+#!/usr/bin/python
+"""
+Report the time it takes to import postman_repl, from python -X importtime.
+
+Run from the repository root:
+    python benchmarks/import_time.py [--runs 5] [--output benchmarks/import_time.txt]
+
+The heavy dependencies (IPython, jinja2, requests) are only imported when they are
+first used, so importing postman_repl should not pull them in.  The script exits
+with an error if it does.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+"""Modules that must not be imported by import postman_repl"""
+LAZY_MODULES = ("IPython", "jinja2", "requests", "requests_oauthlib", "sqlite3", "asyncio", "httpx")
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times():
+    """ Import postman_repl in a fresh interpreter, returning (module, self us, cumulative us, depth) """
+    env = dict(os.environ)
+    # Time the import from the bytecode cache, not the compile
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import postman_repl.postman_repl"],
+                            cwd=ROOT, env=env, stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True).stderr
+    times = []
+    for line in output.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            times.append((match.group(4), int(match.group(1)), int(match.group(2)),
+                          (len(match.group(3)) - 1) // 2))
+
+    # The output lists a module after everything it imported, keep only what postman_repl pulled in
+    # and leave out the interpreter startup
+    end = next(i for i, t in enumerate(times) if t[0] == "postman_repl.postman_repl")
+    start = end
+    while start > 0 and times[start - 1][3] > times[end][3]:
+        start -= 1
+    return times[start:end + 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='postman_repl import time report')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--output', help='Write the report to this file')
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    # The first run may include compiling the module, report the fastest
+    best = min(runs, key=lambda times: next(t[2] for t in times if t[0] == "postman_repl.postman_repl"))
+
+    total = next(t[2] for t in best if t[0] == "postman_repl.postman_repl")
+    lines = ["import postman_repl.postman_repl: {:.1f}ms (best of {})".format(total / 1000.0, args.runs),
+             "",
+             "{:>10} {:>10}  module".format("self ms", "cumul ms")]
+    for module, self_us, cumulative_us, depth in sorted(best, key=lambda t: -t[2])[:args.top]:
+        lines.append("{:>10.1f} {:>10.1f}  {}".format(self_us / 1000.0, cumulative_us / 1000.0, module))
+
+    imported = [m for m in LAZY_MODULES if any(t[0] == m for t in best)]
+    lines.append("")
+    lines.append("Lazily imported modules pulled in at import: {}".format(", ".join(imported) or "none"))
+
+    report = "\n".join(lines) + "\n"
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+    return 1 if imported else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
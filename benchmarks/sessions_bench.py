@@ -0,0 +1,46 @@
+#!/usr/bin/python
+"""
+Benchmark one-off requests against the pooled keep-alive sessions.
+
+Run from the repository root:
+    python benchmarks/sessions_bench.py [--count 500]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import requests
+from postman_repl import postman_repl as pmr
+from local_server import start_server
+
+
+def timeit(count, func):
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Session pooling benchmark')
+    parser.add_argument('--count', type=int, default=500)
+    args = parser.parse_args()
+
+    server, url = start_server()
+
+    sessions = pmr.SessionManager()
+    before = timeit(args.count, lambda: requests.request("GET", url))
+    after = timeit(args.count, lambda: sessions.get_session(url).request("GET", url))
+    sessions.close()
+    server.shutdown()
+
+    print("one-off requests: {:.3f} ms/request".format(before * 1000 / args.count))
+    print("pooled session:   {:.3f} ms/request".format(after * 1000 / args.count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/python
+"""
+Benchmark the hot paths of postman_repl: templating, building the request kwargs,
+converting responses, parsing collections and running requests against a local server.
+
+Run from the repository root:
+    python benchmarks/suite.py [--output results.json] [--compare baseline.json] [--filter regex]
+
+The results are written as JSON, keyed by benchmark name, along with the commit and python
+version they were measured on.  With --compare each benchmark is shown against the baseline
+results, and the script exits with an error if any got slower by more than --max-regression.
+Comparisons use the fastest run of each benchmark, which is the least affected by a noisy machine.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from collections import OrderedDict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from postman_repl import postman_repl as pmr
+from local_server import start_server
+
+"""Holds the benchmarks by name, each a function returning the function to time"""
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """ Register the decorated setup function as the benchmark name """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def make_env():
+    return pmr.O(protocol="https", host="api.example.com", port="443", version="v2",
+                 username="user", password="secret", token="abcdef0123456789", user_id="42")
+
+
+def make_request(folder_id, request_id, url=None):
+    """ Make a postman request that uses the environment in its url, headers, body and auth """
+    return {
+        "id": request_id,
+        "name": "Request {}".format(request_id),
+        "description": "Generated request",
+        "url": url or "{{protocol}}://{{host}}:{{port}}/{{version}}/users/{{user_id}}/items?page=1&size={{size}}",
+        "method": "POST",
+        "headers": "Authorization: Bearer {{token}}\nContent-Type: application/json\nAccept: application/json\n",
+        "dataMode": "raw",
+        "rawModeData": '{"username": "{{username}}", "password": "{{password}}", "id": ' + str(request_id) + '}',
+        "data": [],
+        "currentHelper": "basicAuth",
+        "helperAttributes": {"username": "{{username}}", "password": "{{password}}"},
+        "folder": folder_id,
+    }
+
+
+def make_collection(folders, requests_per_folder, url=None):
+    """ Generate a collection with requests_per_folder requests in each of the folders """
+    collection = {"id": "collection", "name": "Generated", "folders": [], "requests": []}
+    for f in range(folders):
+        folder = {"id": "folder-{}".format(f), "name": "Folder {}".format(f), "description": "", "order": []}
+        for r in range(requests_per_folder):
+            request = make_request(folder["id"], "{}-{}".format(f, r), url=url)
+            folder["order"].append(request["id"])
+            collection["requests"].append(request)
+        collection["folders"].append(folder)
+    return collection
+
+
+def make_payload(items, depth):
+    """ Generate a JSON style payload of items records, each nested depth levels """
+    def record(i, level):
+        value = {"id": i, "name": "item {}".format(i), "active": i % 2 == 0, "score": i * 1.5,
+                 "tags": ["a", "b", "c"]}
+        if level < depth:
+            value["child"] = record(i, level + 1)
+        return value
+    return {"count": items, "items": [record(i, 0) for i in range(items)]}
+
+
+@benchmark("env_replace.template")
+def bench_env_replace_template():
+    env = make_env()
+    url = "{{protocol}}://{{host}}:{{port}}/{{version}}/users/{{user_id}}"
+    return lambda: pmr.env_replace(url, env)
+
+
+@benchmark("env_replace.plain")
+def bench_env_replace_plain():
+    env = make_env()
+    return lambda: pmr.env_replace("application/json", env)
+
+
+@benchmark("set_headers")
+def bench_set_headers():
+    env, request = make_env(), make_request("folder", "request")
+    return lambda: pmr.set_headers(request, {}, env=env)
+
+
+@benchmark("set_url")
+def bench_set_url():
+    env, request = make_env(), make_request("folder", "request")
+    return lambda: pmr.set_url(request, {}, env=env)
+
+
+@benchmark("set_body")
+def bench_set_body():
+    env, request = make_env(), make_request("folder", "request")
+    return lambda: pmr.set_body(request, {}, env=env)
+
+
+@benchmark("runner.prepare")
+def bench_runner_prepare():
+    env = make_env()
+    runner = pmr.get_request(pmr.parse_requests(make_collection(1, 1)), "folder_0.request_0_0")
+    return lambda: runner.prepare(env=env)
+
+
+@benchmark("new_recursive.1000x3")
+def bench_new_recursive():
+    payload = make_payload(1000, 3)
+    return lambda: pmr.new_recursive(**payload)
+
+
+@benchmark("new_lazy.1000x3")
+def bench_new_lazy():
+    payload = make_payload(1000, 3)
+    return lambda: pmr.new_lazy(payload)["items"][500]["child"]["name"]
+
+
+@benchmark("to_dict_recursive.1000x3")
+def bench_to_dict_recursive():
+    o = pmr.new_recursive(**make_payload(1000, 3))
+    return lambda: o._to_dict_recursive()
+
+
+@benchmark("to_json.1000x3")
+def bench_to_json():
+    o = pmr.new_recursive(**make_payload(1000, 3))
+    return lambda: o._to_json()
+
+
+@benchmark("parse_requests.100x50")
+def bench_parse_requests():
+    collection = make_collection(100, 50)
+    return lambda: pmr.parse_requests(collection)
+
+
+@benchmark("load_collection.v2")
+def bench_load_collection_v2():
+    """ Load a v2.1 export of 200 requests nested in folders, each with saved example responses """
+    example = {"name": "Example", "header": [{"key": "Content-Type", "value": "application/json"}],
+               "body": json.dumps(make_payload(20, 1))}
+    items = []
+    for f in range(10):
+        requests = [{"name": "Request {}".format(r),
+                     "request": {"method": "GET", "url": {"raw": make_request(f, r)["url"]}},
+                     "response": [example] * 5}
+                    for r in range(20)]
+        items.append({"name": "Folder {}".format(f), "item": [{"name": "Nested", "item": requests}]})
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"info": {"name": "Generated"}, "item": items}, f)
+    STACK.callback(os.remove, path)
+    return lambda: pmr.load_collection(path)
+
+
+@contextlib.contextmanager
+def local_runner(collection_size=1):
+    """ A Runner for a request to the local server, with the request logging and history kept small """
+    server, url = start_server()
+    collection = pmr.parse_requests(make_collection(1, collection_size, url=url + "users/{{user_id}}?size={{size}}"))
+    old_history, old_level = pmr.H, pmr.LOG.level
+    pmr.H = pmr.History(max_entries=100)
+    pmr.LOG.level = "silent"
+    try:
+        yield pmr.get_request(collection, "folder_0.request_0_0")
+    finally:
+        pmr.H, pmr.LOG.level = old_history, old_level
+        pmr.SESSIONS.close()
+        server.shutdown()
+
+
+@benchmark("runner.call")
+def bench_runner_call():
+    runner = STACK.enter_context(local_runner())
+    env = make_env()
+    return lambda: runner(env=env)
+
+
+@benchmark("runner.map.100x8")
+def bench_runner_map():
+    runner = STACK.enter_context(local_runner())
+    env = make_env()
+    kwargs_list = [{"params": {"page": str(i)}} for i in range(100)]
+    return lambda: runner._map(kwargs_list, concurrency=8, env=env)
+
+
+"""Holds the contexts opened by the benchmark setups, closed after each benchmark"""
+STACK = contextlib.ExitStack()
+
+
+def time_benchmark(func, repeat, min_time):
+    """ Time func, returning the seconds per call of each of the repeat runs """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.2))
+    return number, [elapsed / number] + [timer.timeit(number) / number for _ in range(repeat - 1)]
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, repeat, min_time):
+    results = OrderedDict()
+    for name in names:
+        with STACK:
+            func = BENCHMARKS[name]()
+            # Warm up the caches and lazy imports, they are measured by import_time.py instead
+            func()
+            number, times = time_benchmark(func, repeat, min_time)
+        results[name] = OrderedDict([
+            ("median_us", statistics.median(times) * 1e6),
+            ("min_us", min(times) * 1e6),
+            ("ops_per_sec", 1.0 / statistics.median(times)),
+            ("number", number),
+            ("repeat", repeat),
+        ])
+        sys.stderr.write("{:<28} {:>12.2f} us\n".format(name, results[name]["median_us"]))
+    return results
+
+
+def format_results(results, baseline=None):
+    lines = ["{:<28} {:>12} {:>12} {:>12}".format("benchmark", "median us", "min us", "ops/s")]
+    if baseline:
+        lines[0] += " {:>12} {:>8}".format("baseline min", "change")
+    for name, result in results.items():
+        line = "{:<28} {:>12.2f} {:>12.2f} {:>12.0f}".format(
+            name, result["median_us"], result["min_us"], result["ops_per_sec"])
+        if baseline and name in baseline:
+            before = baseline[name]["min_us"]
+            line += " {:>12.2f} {:>+7.1f}%".format(before, (result["min_us"] / before - 1) * 100)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='postman_repl benchmark suite')
+    parser.add_argument('--output', '-o', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', '-c', help='Compare against the results in this JSON file')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='With --compare, fail if a benchmark is this fraction slower than the baseline')
+    parser.add_argument('--filter', '-f', help='Only run the benchmarks whose name matches this regex')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='The minimum seconds each timed run takes')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks and exit')
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if not args.filter or re.search(args.filter, name)]
+    if args.list:
+        print("\n".join(names))
+        return 0
+
+    results = run(names, args.repeat, args.min_time)
+    output = OrderedDict([
+        ("commit", get_commit()),
+        ("timestamp", time.time()),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("results", results),
+    ])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+            f.write("\n")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print(format_results(results, baseline))
+
+    if baseline:
+        slower = [name for name, result in results.items()
+                  if name in baseline and result["min_us"] > baseline[name]["min_us"] * (1 + args.max_regression)]
+        if slower:
+            print("\nSlower than the baseline by more than {:.0f}%: {}".format(args.max_regression * 100,
+                                                                             ", ".join(slower)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,16 +5,24 @@ Script for starting a repl with postman configs/env loaded.
 
 
 import argparse
+import atexit
+import codecs
+import contextlib
 import json
-import pprint
+import json.decoder
+import marshal
+import os
+import queue
 import re
 import sys
 import copy
+import threading
+import time
+import weakref
+from itertools import islice, repeat
+from collections import ChainMap, OrderedDict, deque
 from urllib.parse import urlparse, parse_qs
 import importlib.machinery
-import IPython
-from jinja2 import Template
-import requests
 
 
 class O(object):
@@ -26,18 +34,31 @@ class O(object):
     Modified from: http://www.adequatelygood.com/JavaScript-Style-Objects-in-Python.html
     """
 
+    # The version is kept in a slot so it never shows up as one of the O's keys
+    __slots__ = ('__dict__', '__weakref__', '__version')
+
     def __init__(self, **kwargs):
+        object.__setattr__(self, '_O__version', 0)
         self.__dict__.update(kwargs)
 
     def __getitem__(self, name):
         return self.__dict__.get(name, None)
 
     def __setitem__(self, name, val):
-        return self.__dict__.__setitem__(name, val)
+        self.__dict__.__setitem__(name, val)
+        object.__setattr__(self, '_O__version', self._version() + 1)
 
     def __delitem__(self, name):
         if name in self.__dict__:
             del self.__dict__[name]
+            object.__setattr__(self, '_O__version', self._version() + 1)
+
+    def _version(self):
+        """ Counter bumped every time a key is set or deleted on this O """
+        try:
+            return object.__getattribute__(self, '_O__version')
+        except AttributeError:
+            return 0
 
     def __getattr__(self, name):
         return self.__getitem__(name)
@@ -51,8 +72,13 @@ class O(object):
     def __iter__(self):
         return self.__dict__.__iter__()
 
+    def __contains__(self, name):
+        return name in self.__dict__
+
     def __repr__(self):
-        return pprint.pformat(self._to_dict_recursive(), width=4)
+        import pprint
+        data = to_plain(self, copy_leaves=False, max_depth=REPR_MAX_DEPTH, max_items=REPR_MAX_ITEMS)
+        return pprint.pformat(data, width=4)
 
     def __str__(self):
         return self.__dict__.__str__()
@@ -60,40 +86,26 @@ class O(object):
     def _to_dict(self):
         return self.__dict__.copy()
 
-    def _to_dict_recursive(self):
-        """ Recursively converts all Os to dicts """
-        def handle_list(l):
-            out = []
-            for x in l:
-                if isinstance(x, O):
-                    out.append(x._to_dict_recursive())
-                elif isinstance(x, (list, tuple)):
-                    out.append(handle_list(x))
-                else:
-                    out.append(copy.copy(x))
-            return out
-
-        newDict = {}
-        for k, v in self.__dict__.items():
-            if isinstance(v, O):
-                newDict[k] = v._to_dict_recursive()
-            elif isinstance(v, (list, tuple)):
-                newDict[k] = handle_list(v)
-            else:
-                newDict[k] = copy.copy(v)
-        return newDict
+    def _to_dict_recursive(self, copy_leaves=True):
+        """ Recursively converts all Os to dicts. Pass copy_leaves=False to skip copying the values """
+        return to_plain(self, copy_leaves=copy_leaves)
 
     def _to_json(self):
         """ Converts the O to JSON """
-        return json.dumps(self._to_dict_recursive())
+        try:
+            return json.dumps(self, default=json_default)
+        except RecursionError:
+            return encode_json(self)
 
     def _pformat(self):
         """ Pretty Format the object """
-        return pprint.pformat(self._to_dict_recursive())
+        import pprint
+        return pprint.pformat(self._to_dict_recursive(copy_leaves=False))
 
     def _pp(self):
         """ Pretty Print the object """
-        pprint.pprint(self._to_dict_recursive())
+        import pprint
+        pprint.pprint(self._to_dict_recursive(copy_leaves=False))
 
     def _update(self, newO):
         """ Update the current O with the fields from the given O """
@@ -108,6 +120,234 @@ class O(object):
         new_data = new_recursive(**kwargs)
         return output._update(new_data)
 
+    def _layer(self, **kwargs):
+        """ Layers kwargs, turned into Os, over the object without copying it.  See ChainO """
+        return ChainO(self, **new_recursive(**kwargs).__dict__)
+
+
+class ChainO(O):
+    """
+    An O layered over parent Os, like a ChainMap.  Keys are read from its own layer, then from each parent
+    in turn, and setting or deleting a key only changes its own layer, leaving the parents as they are.
+    Layering overrides over a large O costs only the overrides, and changes to the parents show through.
+    Layering a ChainO again snapshots its own keys instead, see _layer.
+    Nested values are shared with the parents rather than copied.
+    """
+    __slots__ = ('__parents', '__deleted')
+
+    def __init__(self, *parents, **kwargs):
+        object.__setattr__(self, '_ChainO__parents', parents)
+        object.__setattr__(self, '_ChainO__deleted', set())
+        O.__init__(self, **kwargs)
+
+    def __getitem__(self, name):
+        if name in self.__dict__:
+            return self.__dict__[name]
+        if name in self.__deleted:
+            return None
+        for parent in self.__parents:
+            if name in parent:
+                return parent[name]
+        return None
+
+    def __setitem__(self, name, val):
+        self.__deleted.discard(name)
+        O.__setitem__(self, name, val)
+
+    def __delitem__(self, name):
+        if name in self.__dict__:
+            O.__delitem__(self, name)
+        if name not in self.__deleted and any(name in parent for parent in self.__parents):
+            self.__deleted.add(name)
+            object.__setattr__(self, '_O__version', O._version(self) + 1)
+
+    def __contains__(self, name):
+        if name in self.__dict__:
+            return True
+        return name not in self.__deleted and any(name in parent for parent in self.__parents)
+
+    def _version(self):
+        """ Counter bumped every time a key is set or deleted on this O or its parents """
+        return O._version(self) + sum(parent._version() for parent in self.__parents)
+
+    def _layer(self, **kwargs):
+        """
+        Layers kwargs, turned into Os, over a shallow copy of this O's own keys, chained to the same parents,
+        so that layering again and again doesn't nest ever deeper.  Changes to the parents show through the
+        new layer, but changes made to this O's own keys afterwards don't.
+        """
+        layer = ChainO(*self.__parents, **self.__dict__)
+        layer.__deleted.update(self.__deleted)
+        for name, value in new_recursive(**kwargs).__dict__.items():
+            layer[name] = value
+        return layer
+
+    def _parents(self):
+        """ The parent Os, the first is read first """
+        return self.__parents
+
+    def _deleted(self):
+        """ The keys of the parents deleted from this O """
+        return self.__deleted
+
+    def __iter__(self):
+        return iter(self._to_dict())
+
+    def __str__(self):
+        return self._to_dict().__str__()
+
+    def _to_dict(self):
+        data = {}
+        for parent in reversed(self.__parents):
+            data.update(get_o_dict(parent))
+        for name in self.__deleted:
+            data.pop(name, None)
+        data.update(self.__dict__)
+        return data
+
+
+"""The maximum depth of nested data shown in the repr of an O"""
+REPR_MAX_DEPTH = 8
+"""The maximum number of items of each dict or list shown in the repr of an O"""
+REPR_MAX_ITEMS = 100
+
+"""Types that are immutable, and never need copying"""
+ATOMIC_TYPES = frozenset([str, int, float, bool, type(None), bytes])
+"""Types that are converted into plain dicts and lists"""
+CONTAINER_TYPES = (O, dict, list, tuple)
+
+
+def is_container(value):
+    return isinstance(value, CONTAINER_TYPES)
+
+
+def get_o_dict(value):
+    """ Get the dict holding the keys of an O, merged from its layers for a ChainO """
+    if isinstance(value, ChainO):
+        return value._to_dict()
+    return value.__dict__
+
+
+def iter_container(value):
+    """ Iterate the (key, value) pairs of a container, with None keys for lists and tuples """
+    if isinstance(value, O):
+        return iter(get_o_dict(value).items())
+    elif isinstance(value, dict):
+        return iter(value.items())
+    elif isinstance(value, list):
+        # Iterate the raw items so a LazyList doesn't wrap them all first
+        return zip(repeat(None), list.__iter__(value))
+    return zip(repeat(None), value)
+
+
+def to_plain(value, copy_leaves=True, max_depth=None, max_items=None):
+    """
+    Converts Os, dicts, lists and tuples to plain dicts and lists.
+    Iterative, so deeply nested data doesn't hit the recursion limit.
+    Past max_depth containers are replaced with "{...}" or "[...]",
+    and only the first max_items of each container are kept.
+    """
+    def convert_leaf(leaf):
+        if not copy_leaves or type(leaf) in ATOMIC_TYPES:
+            return leaf
+        return copy.copy(leaf)
+
+    def new_child(child, depth):
+        is_dict = isinstance(child, (O, dict))
+        if max_depth is not None and depth >= max_depth:
+            return "{...}" if is_dict else "[...]"
+        target = {} if is_dict else []
+        # Every target is already in place in its parent, so the order they're filled in doesn't matter
+        stack.append((child, target, depth + 1))
+        return target
+
+    if not is_container(value):
+        return convert_leaf(value)
+
+    result = {} if isinstance(value, (O, dict)) else []
+    stack = [(value, result, 1)]
+    while stack:
+        source, target, depth = stack.pop()
+        if isinstance(source, O):
+            source = get_o_dict(source)
+        is_dict = isinstance(source, dict)
+        if is_dict:
+            items = source.items()
+        elif isinstance(source, list):
+            # Iterate the raw items so a LazyList doesn't wrap them all first
+            items = list.__iter__(source)
+        else:
+            items = source
+        truncated = max_items is not None and len(source) > max_items
+        if truncated:
+            items = islice(items, max_items)
+
+        if is_dict:
+            for k, v in items:
+                if type(v) in ATOMIC_TYPES:
+                    target[k] = v
+                elif isinstance(v, CONTAINER_TYPES):
+                    target[k] = new_child(v, depth)
+                else:
+                    target[k] = convert_leaf(v)
+        else:
+            append = target.append
+            for v in items:
+                if type(v) in ATOMIC_TYPES:
+                    append(v)
+                elif isinstance(v, CONTAINER_TYPES):
+                    append(new_child(v, depth))
+                else:
+                    append(convert_leaf(v))
+
+        if truncated:
+            more = "... {} more".format(len(source) - max_items)
+            if is_dict:
+                target["..."] = more
+            else:
+                target.append(more)
+    return result
+
+
+def json_default(value):
+    """ default hook for json.dumps, encoding Os as their dict """
+    if isinstance(value, O):
+        return get_o_dict(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def encode_json(value):
+    """ JSON encode the value iteratively, for data too deeply nested for json.dumps """
+    encode = json.JSONEncoder(default=json_default).encode
+    parts = []
+
+    def open_container(container):
+        is_dict = isinstance(container, (O, dict))
+        parts.append("{" if is_dict else "[")
+        return [iter_container(container), "}" if is_dict else "]", True, is_dict]
+
+    if not is_container(value):
+        return encode(value)
+
+    stack = [open_container(value)]
+    while stack:
+        frame = stack[-1]
+        items, closer, _, is_dict = frame
+        for key, item in items:
+            if not frame[2]:
+                parts.append(", ")
+            frame[2] = False
+            if is_dict:
+                parts.append(encode(key if isinstance(key, str) else str(key)) + ": ")
+            if is_container(item):
+                stack.append(open_container(item))
+                break
+            parts.append(encode(item))
+        else:
+            parts.append(closer)
+            stack.pop()
+    return "".join(parts)
+
 
 def new_recursive(**data):
     """ Recursively converts all dicts to O and returns the object """
@@ -147,6 +387,60 @@ def new_recursive_list(*data):
     return output
 
 
+class LazyO(O):
+    """
+    An O view over an already parsed JSON dict.
+    Child dicts and lists are only wrapped when they are accessed,
+    so large responses don't have to be converted up front.
+    """
+
+    def __init__(self, data):
+        object.__setattr__(self, '_O__version', 0)
+        object.__setattr__(self, '__dict__', data)
+
+    def __getitem__(self, name):
+        value = self.__dict__.get(name, None)
+        wrapped = new_lazy(value)
+        if wrapped is not value:
+            self.__dict__[name] = wrapped
+        return wrapped
+
+    def __getattribute__(self, name):
+        # Keys are found in the instance __dict__ before __getattr__ is tried, wrap them on the way out
+        if name in object.__getattribute__(self, '__dict__'):
+            return LazyO.__getitem__(self, name)
+        return object.__getattribute__(self, name)
+
+
+class LazyList(list):
+    """
+    A list view over an already parsed JSON list.
+    Dicts and lists in it are only wrapped when they are accessed.
+    """
+
+    def __getitem__(self, index):
+        value = list.__getitem__(self, index)
+        if isinstance(index, slice):
+            return LazyList(value)
+        wrapped = new_lazy(value)
+        if wrapped is not value:
+            list.__setitem__(self, index, wrapped)
+        return wrapped
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def new_lazy(data):
+    """ Wraps the parsed JSON data in a LazyO or LazyList, leaving any other values as they are """
+    if type(data) is dict:
+        return LazyO(data)
+    elif type(data) is list:
+        return LazyList(data)
+    return data
+
+
 class Folder(O):
 
     def _get_repr(self, level=0):
@@ -175,25 +469,201 @@ class Folder(O):
     def __repr__(self):
         return self._get_repr()
 
+    def _runners(self, prefix=""):
+        """ Get the (folder.request name, Runner) of every request in this folder and its sub folders """
+        runners = []
+        for x in self:
+            if x.startswith("_"):
+                continue
+            if isinstance(self[x], Folder):
+                runners.extend(self[x]._runners(prefix + x + "."))
+            elif isinstance(self[x], Runner):
+                runners.append((prefix + x, self[x]))
+
+        if self.META and self.META.order:
+            # Run in the order the folder lists its requests
+            order = {request_id: i for i, request_id in enumerate(self.META.order)}
+            runners.sort(key=lambda r: order.get(r[1].request.get("id"), len(order)))
+        return runners
+
+    def _run_all(self, concurrency=8, depends=None, env=None):
+        """
+        Run every request in the folder, running requests that don't depend on each other concurrently.
+        See run_all for how the dependencies are found.
+        """
+        prefix = self.META.folder_name + "." if self.META else ""
+        return run_all(self._runners(prefix), concurrency=concurrency, depends=depends, env=env)
+
+
+def iter_chunks(response, chunk_size=65536):
+    """ Iterate the raw body chunks of a streamed response """
+    return response.iter_content(chunk_size=chunk_size)
+
+
+def save_stream(response, path, chunk_size=65536):
+    """ Write the body of a streamed response to the file at path, returning the path """
+    with open(path, "wb") as f:
+        for chunk in iter_chunks(response, chunk_size=chunk_size):
+            f.write(chunk)
+    return path
+
+
+class ChunkReader(object):
+    """ A file-like reader over an iterator of byte chunks, so a streamed response can be read by JsonStream """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def read(self, size):
+        """ Read at least size bytes, or fewer at the end of the chunks """
+        chunks = []
+        length = 0
+        for chunk in self.chunks:
+            chunks.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                break
+        return b"".join(chunks)
+
+
+def iter_json_items(response, chunk_size=65536):
+    """
+    Incrementally parse a streamed response holding a top level JSON array,
+    yielding each item as it is read.  Only the current item is held in memory.
+    """
+    stream = JsonStream(ChunkReader(iter_chunks(response, chunk_size=chunk_size)), chunk_size=chunk_size,
+                        encoding=response.encoding or "utf-8")
+    if stream.peek() != "[":
+        raise ValueError("Response is not a JSON array")
+    for _ in stream.iter_array():
+        yield new_lazy(stream.value())
+
+
+def iter_ndjson(response):
+    """ Parse a streamed newline delimited JSON response, yielding each item as it is read """
+    for line in response.iter_lines():
+        if line.strip():
+            yield new_lazy(json.loads(line.decode(response.encoding or "utf-8")))
+
+
+class LazyDocstring(object):
+    """
+    Descriptor that builds an instance's __doc__ with the given method only when it is accessed,
+    keeping the class docstring on the class.
+    """
+    def __init__(self, doc, method_name):
+        self.doc = doc
+        self.method_name = method_name
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self.doc
+        return getattr(obj, self.method_name)()
+
+
 class HistoryRunner(object):
     """
     Holds the state for a history request.
     Represents a ran request in the History that can be replayed.
     """
-    def __init__(self, request, kwargs, env, middleware, auth, url, results=None, data=None, json=None):
+    __doc__ = LazyDocstring(__doc__, "_get_info")
+
+    def __init__(self, request, kwargs, env, middleware, auth, url, results=None, data=None, json=None,
+                 request_name=None, folder_name=None):
         self.request = request
+        self.request_name = request_name
+        self.folder_name = folder_name
         self.kwargs = kwargs
         self.env = env
         self.middleware = middleware
         self.auth = auth
         self.url = url
         self.results = results
-        self.data = data
-        self.json = json
+        self._data = data
+        self._json = json
+        self.body_path = None
+        self.spill_path = None
+        self.body_loader = None
+        self.tracked_bytes = 0
+        self.status_code = results.status_code if results is not None else None
+        self.timestamp = None
+        self.cache_status = None
+        self.prepare_time = 0.0
+        self.timings = O()
+        self.span = None
+
+    @property
+    def data(self):
+        """ The response data, read back from the spill file if it was evicted from memory """
+        if self._data is None and self.spill_path is not None:
+            with open(self.spill_path, "rb") as f:
+                return f.read()
+        if self._data is None and self.body_loader is not None:
+            return self.body_loader()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.delete_spill()
+
+    @property
+    def json(self):
+        """ The response data parsed as JSON, parsed again from the spill file if it was evicted """
+        if self._json is None and self._data is None and (self.spill_path or self.body_loader):
+            try:
+                return new_lazy(json.loads(self.data.decode("utf-8")))
+            except (ValueError, AttributeError):
+                return None
+        return self._json
+
+    @json.setter
+    def json(self, json_data):
+        self._json = json_data
+
+    def body_size(self):
+        """ The size of the response body held in memory """
+        return len(self._data) if self._data else 0
+
+    def evict_body(self, spill_dir=None):
+        """ Drop the response body from memory, first writing it to spill_dir if given """
+        if self._data is None:
+            return
+        if spill_dir is not None:
+            import tempfile
+            fd, self.spill_path = tempfile.mkstemp(suffix=".body", dir=spill_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._data)
+        self._data = None
+        self._json = None
+        # The response holds the same body, but it may still be in use by the caller, so only let go of it
+        self.results = None
+
+    def delete_spill(self):
+        """ Remove the spill file for the body, if there is one """
+        if self.spill_path is not None:
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+            self.spill_path = None
 
     def short_repr(self):
         return "[{method}] {url}".format(method=self.request["method"], url=self.url)
 
+    def get_name(self):
+        """ The folder.request name of the request, or its method and url if it wasn't run from a collection """
+        if self.request_name:
+            return self.folder_name + "." + self.request_name if self.folder_name else self.request_name
+        return self.short_repr()
+
+    def format_timings(self):
+        """ Format the phase timings of the last run, ex: prepare=0.1ms connect=2.0ms ... total=10.5ms """
+        return " ".join("{}={:.1f}ms".format(phase, self.timings[phase] * 1000)
+                        for phase in TIMING_PHASES if phase in self.timings)
+
+    def add_timing(self, phase, seconds):
+        self.timings[phase] = (self.timings[phase] or 0.0) + seconds
+
     def __repr__(self):
         return self._get_info()
 
@@ -203,56 +673,326 @@ class HistoryRunner(object):
         output += "Headers: {}\n".format(json.dumps(self.kwargs.get("headers")))
         output += "Data: \n{}\n".format(self.kwargs.get("data"))
 
-        if self.results is not None:
-            data = self.json or self.data
-            output += "RESULTS: \nStatus Code: {}\n{}".format(self.results.status_code, data)
+        if self.status_code is not None:
+            if self.kwargs.get("stream"):
+                data = "Streamed body saved to: {}".format(self.body_path) if self.body_path else "Streamed body"
+            else:
+                data = self.json or self.data
+            if self.cache_status is not None:
+                output += "Cache: {}\n".format(self.cache_status)
+            if self.timings:
+                output += "Timings: {}\n".format(self.format_timings())
+            output += "RESULTS: \nStatus Code: {}\n{}".format(self.status_code, data)
 
         return output
 
     def inner_run(self, kwargs):
-        global J, D, R
         if kwargs is None:
             raise ValueError("Must pass kwargs to request from middleware")
 
-        if self.auth is None:
-            R = do_no_auth_request(self.request, self.url, **kwargs)
-        elif isinstance(self.auth, requests.auth.AuthBase):
-            R = do_custom_auth_request(self.request, self.url, self.auth, **kwargs)
-        elif self.auth.type == "oAuth1":
-            R = do_oauth1_request(self.request, self.url, self.auth, **kwargs)
-        elif self.auth.type == "basicAuth":
-            R = do_basic_auth_request(self.request, self.url, self.auth, **kwargs)
-        elif self.auth.type == "digestAuth":
-            R = do_digest_auth_request(self.request, self.url, self.auth, **kwargs)
+        span = INSTRUMENTS.start("http", self, parent=self.span) if INSTRUMENTS.exporters else None
+        REQUEST_TIMER.reset()
+        start = time.perf_counter()
+        error = None
+        try:
+            return self.send_and_parse(kwargs, start)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if span is not None:
+                INSTRUMENTS.end(span, self, time.perf_counter() - start, error=error)
+
+    def send_and_parse(self, kwargs, start):
+        """ Send the request, read its body and record the timings, for inner_run """
+        session = SESSIONS.get_session(self.url, env=self.env)
+
+        def send(kwargs):
+            if CASSETTE.mode is not None:
+                return CASSETTE.fetch(self.request["method"], self.url, kwargs,
+                                      lambda kwargs: self.send(kwargs, session))
+            return self.send(kwargs, session)
+
+        self.timestamp = time.time()
+        vary = CACHE.get_vary(self.auth)
+        if CACHE.enabled and not kwargs.get("stream") and vary is not False:
+            response, self.cache_status = CACHE.fetch(self.request["method"], self.url, kwargs, send, vary=vary)
         else:
-            print("Attempting no auth request with unknown auth type", self.auth)
-            R = do_no_auth_request(self.request, self.url, **kwargs)
+            response = send(kwargs)
+            self.cache_status = None
+        sent = time.perf_counter()
+
+        self.results = response
+        self.status_code = response.status_code
+        if kwargs.get("stream"):
+            # Leave the body unread, it is consumed by the caller
+            self.data = None
+            self.json = None
+        else:
+            self.data = response.content
+            try:
+                self.json = new_lazy(response.json())
+            except:
+                self.json = None
+        parsed = time.perf_counter()
+
+        # Only the adapters of the pooled sessions record the connect and response times
+        elapsed = response.elapsed.total_seconds() if getattr(response, "elapsed", None) is not None else 0.0
+        download = sent - REQUEST_TIMER.headers if REQUEST_TIMER.headers is not None else 0.0
+        network = REQUEST_TIMER.connect + REQUEST_TIMER.tls + max(elapsed - REQUEST_TIMER.connect - REQUEST_TIMER.tls, 0.0)
+        self.add_timing("connect", REQUEST_TIMER.connect)
+        self.add_timing("tls", REQUEST_TIMER.tls)
+        self.add_timing("wait", network - REQUEST_TIMER.connect - REQUEST_TIMER.tls)
+        self.add_timing("download", download)
+        self.add_timing("client", max(sent - start - network - download, 0.0))
+        self.add_timing("parse", parsed - sent)
+        self.add_timing("request", parsed - start)
+
+        return response
+
+    def send(self, kwargs, session):
+        """ Send the request with the auth type of this request """
+        return send_request(self.request, self.url, self.auth, session=session, **kwargs)
+
+    def set_globals(self):
+        """ Set the R, J and D globals to the results of this request """
+        global R, J, D
+        R = self.results
+        if self.json is not None:
+            J = self.json
+        D = self.data
+
+    def start_run(self):
+        """ Reset the timings and start the request span for a run, returning when it started """
+        self.timings = O(prepare=self.prepare_time)
+        self.prepare_time = 0.0
+        self.span = INSTRUMENTS.start("request", self, elapsed=self.timings.prepare) if INSTRUMENTS.exporters else None
+        return time.perf_counter()
+
+    def end_run(self, start, error=None):
+        """ Record the total and middleware time of the run that started at start, and end its span """
+        total = time.perf_counter() - start
+        self.timings.middleware = total - (self.timings.request or 0.0)
+        self.timings.total = self.timings.prepare + total
+        if self.span is not None:
+            INSTRUMENTS.end(self.span, self, self.timings.total, error=error)
+
+    def __call__(self, update_globals=True):
+        """ Used to re-run from history.  Unless update_globals is False, R, J and D are set to the results """
+        start = self.start_run()
+        error = None
+        try:
+            result = self.middleware(self.inner_run, self.kwargs, self.env)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.end_run(start, error=error)
+        if update_globals and self.results is not None:
+            self.set_globals()
+        return result
+
+
+class AsyncHistoryRunner(HistoryRunner):
+    """
+    Holds the state for a history request sent with the asyncio client, await it to run the request.
+    Middleware can be a coroutine function, which awaits run(kwargs).  Other middleware runs in a thread,
+    where run(kwargs) waits for the request on the event loop, so existing middleware works unchanged.
+    """
+    __doc__ = LazyDocstring(__doc__, "_get_info")
+
+    async def __call__(self, update_globals=True):
+        """ Used to re-run from history.  Unless update_globals is False, R, J and D are set to the results """
+        import asyncio
 
+        start = self.start_run()
+        error = None
         try:
-            json_data = R.json()
-            if isinstance(json_data, dict):
-                J = new_recursive(**json_data)
-            elif isinstance(json_data, (list, tuple)):
-                J = new_recursive_list(*json_data)
+            if self.middleware is default_middleware:
+                result = await self.inner_run(self.kwargs)
+            elif asyncio.iscoroutinefunction(self.middleware):
+                result = await self.middleware(self.inner_run, self.kwargs, self.env)
             else:
-                J = json_data
+                loop = asyncio.get_running_loop()
+
+                def run(kwargs):
+                    return asyncio.run_coroutine_threadsafe(self.inner_run(kwargs), loop).result()
+
+                result = await loop.run_in_executor(None, self.middleware, run, self.kwargs, self.env)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.end_run(start, error=error)
+        if update_globals and self.results is not None:
+            self.set_globals()
+        return result
+
+    async def inner_run(self, kwargs):
+        if kwargs is None:
+            raise ValueError("Must pass kwargs to request from middleware")
+
+        span = INSTRUMENTS.start("http", self, parent=self.span) if INSTRUMENTS.exporters else None
+        start = time.perf_counter()
+        error = None
+        try:
+            return await self.send_and_parse(kwargs, start)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if span is not None:
+                INSTRUMENTS.end(span, self, time.perf_counter() - start, error=error)
+
+    async def send_and_parse(self, kwargs, start):
+        """ Send the request, read its body and record the timings, for inner_run """
+        self.timestamp = time.time()
+        self.cache_status = None
+        if CACHE.enabled:
+            import warnings
+            warnings.warn("The response cache isn't used by async requests, they are always sent", stacklevel=2)
+        if CASSETTE.mode == "replay":
+            response = CASSETTE.fetch(self.request["method"], self.url, kwargs, None)
+        else:
+            client = SESSIONS.get_async_client(**{name: kwargs.get(name) for name in HTTPX_CLIENT_KWARGS})
+            response = await self.send(kwargs, client)
+            if CASSETTE.mode == "record":
+                CASSETTE.fetch(self.request["method"], self.url, kwargs, lambda kwargs: response)
+        sent = time.perf_counter()
+
+        self.results = response
+        self.status_code = response.status_code
+        self.data = response.content
+        try:
+            self.json = new_lazy(response.json())
         except:
-            pass
+            self.json = None
+        parsed = time.perf_counter()
+
+        # The async client doesn't report connect time, wait covers the whole exchange
+        wait = response.elapsed.total_seconds() if response.elapsed is not None else 0.0
+        self.add_timing("wait", wait)
+        self.add_timing("client", max(sent - start - wait, 0.0))
+        self.add_timing("parse", parsed - sent)
+        self.add_timing("request", parsed - start)
+
+        return response
+
+    async def send(self, kwargs, client):
+        """ Send the request with the async client, returning it as a requests Response """
+        LOG.log(self.request["method"], self.url, kwargs, self.auth)
+        response = await client.request(self.request["method"], self.url,
+                                        auth=get_httpx_auth(self.auth, self.request, self.url),
+                                        **get_httpx_kwargs(kwargs))
+        result = ResponseCache.make_response({
+            "status_code": response.status_code,
+            "reason": response.reason_phrase,
+            "url": str(response.url),
+            "encoding": response.encoding,
+            "headers": {name: ", ".join(response.headers.get_list(name)) for name in response.headers.keys()},
+            "content": response.content,
+        })
+        result.elapsed = response.elapsed
+        return result
+
+
+"""The kwargs for requests that httpx sets on the client, see SessionManager.get_async_client"""
+HTTPX_CLIENT_KWARGS = ("verify", "cert", "proxies")
+
+
+def get_httpx_kwargs(kwargs):
+    """
+    Convert the kwargs for requests into the kwargs for httpx.
+    The client kwargs are dropped, they are passed to SessionManager.get_async_client instead.
+    """
+    kwargs = dict(kwargs)
+    for name in HTTPX_CLIENT_KWARGS:
+        kwargs.pop(name, None)
+    # The async runner always reads the whole body
+    if kwargs.pop("stream", None):
+        raise ValueError("stream is not supported by async requests")
+    if kwargs.pop("hooks", None):
+        raise ValueError("hooks is not supported by async requests")
+    data = kwargs.pop("data", None)
+    if isinstance(data, (str, bytes)):
+        kwargs["content"] = data
+    elif data is not None:
+        kwargs["data"] = data
+    # requests follows redirects by default, httpx doesn't
+    kwargs["follow_redirects"] = kwargs.pop("allow_redirects", True)
+    return kwargs
 
-        D = R.content
 
-        return R
+def build_httpx_auth(auth):
+    """ Build the httpx auth for the auth """
+    import httpx
+    if auth.type == "basicAuth":
+        return httpx.BasicAuth(auth.username, auth.password)
+    elif auth.type == "digestAuth":
+        return httpx.DigestAuth(auth.username, auth.password)
+    elif auth.type == "oAuth1":
+        return get_httpx_oauth1_class()(auth)
+    return None
+
+
+def get_httpx_auth(auth, request=None, url=None):
+    """
+    Get the httpx auth for the auth of a request, reused from AUTH_HANDLERS when the request is given.
+    Custom auth must already be usable by httpx
+    """
+    if auth is None:
+        return None
+    elif not isinstance(auth, O):
+        return auth
+    elif auth.type not in AUTH_FIELDS:
+        print("Attempting no auth request with unknown auth type", auth)
+        return None
+    elif request is None:
+        return build_httpx_auth(auth)
+    return AUTH_HANDLERS.get("httpx", request, url, auth, build_httpx_auth)
 
-    def __call__(self):
-        """ Used to re-run from history """
-        return self.middleware(self.inner_run, self.kwargs, self.env)
+
+"""The httpx auth for oAuth1, built on first use so httpx isn't imported with the module"""
+HttpxOAuth1 = None
+
+
+def get_httpx_oauth1_class():
+    """ Get the httpx auth that signs requests with oAuth1, like requests_oauthlib.OAuth1 """
+    global HttpxOAuth1
+    if HttpxOAuth1 is not None:
+        return HttpxOAuth1
+
+    import httpx
+    from oauthlib.oauth1 import Client
+
+    class OAuth1(httpx.Auth):
+        requires_request_body = True
+
+        def __init__(self, auth):
+            self.client = Client(auth.consumer_key, client_secret=auth.consumer_secret,
+                                 resource_owner_key=auth.access_token,
+                                 resource_owner_secret=auth.access_token_secret)
+
+        def auth_flow(self, request):
+            # Only form bodies are part of the signature
+            form = request.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded")
+            body = request.content.decode("utf-8") if form and request.content else None
+            headers = {"Content-Type": request.headers["Content-Type"]} if form else {}
+            _, signed, _ = self.client.sign(str(request.url), request.method, body, headers)
+            request.headers["Authorization"] = signed["Authorization"]
+            yield request
+
+    HttpxOAuth1 = OAuth1
+    return HttpxOAuth1
 
 
 class Runner(object):
     """
     Holds the state for running a request.
     """
-    def __init__(self, request, request_name, folder, env, middlewares, kwargs=None):
+    __doc__ = LazyDocstring(__doc__, "get_docstring")
+
+    def __init__(self, request, request_name, folder, env, middlewares, kwargs=None, plan=None):
         self.request = request
         self.request_name = request_name
         self.folder = folder
@@ -260,6 +1000,29 @@ class Runner(object):
         self.kwargs = kwargs or {}
         self.middlewares = middlewares
         self.META = O(**request)
+        self._plan = plan
+        self._middleware = None
+
+    @property
+    def plan(self):
+        """ The compiled RequestPlan, built on the first call """
+        if self._plan is None:
+            self._plan = RequestPlan(self.request)
+        return self._plan
+
+    def get_middleware(self, middlewares):
+        """ Get the middleware for this request, looking it up again only if the middlewares changed """
+        middlewares = middlewares or MW
+        version = middlewares._version() if isinstance(middlewares, O) else None
+        cached = self._middleware
+        if cached is not None and cached[0] is middlewares and cached[1] == version:
+            return cached[2]
+        middleware = get_middleware(self.folder, self.request_name, middlewares=middlewares)
+        self._middleware = (middlewares, version, middleware)
+        return middleware
+
+    def get_docstring(self):
+        return build_docstring(self.request, self.folder)
 
     def default_data(self):
         data = get_default_request_data(self.request, env=self.env)
@@ -272,9 +1035,10 @@ class Runner(object):
         return Runner(self.request,
                       self.request_name,
                       self.folder,
-                      self.env._copy(**kwargs),
+                      self.env._layer(**kwargs),
                       self.middlewares,
-                      self.kwargs)
+                      self.kwargs,
+                      plan=self.plan)
 
     def add_params(self, **kwargs):
         new_kwargs = self.kwargs.copy()
@@ -287,7 +1051,8 @@ class Runner(object):
                       self.folder,
                       self.env,
                       self.middlewares,
-                      new_kwargs)
+                      new_kwargs,
+                      plan=self.plan)
 
     def add_headers(self, **kwargs):
         new_kwargs = self.kwargs.copy()
@@ -300,7 +1065,8 @@ class Runner(object):
                       self.folder,
                       self.env,
                       self.middlewares,
-                      new_kwargs)
+                      new_kwargs,
+                      plan=self.plan)
 
     def add_kwargs(self, **kwargs):
         return Runner(self.request,
@@ -308,7 +1074,8 @@ class Runner(object):
                       self.folder,
                       self.env,
                       self.middlewares,
-                      self.kwargs.copy.update(**kwargs))
+                      self.kwargs.copy.update(**kwargs),
+                      plan=self.plan)
 
     def __repr__(self):
         return self.__doc__
@@ -316,43 +1083,129 @@ class Runner(object):
     def short_repr(self):
         return "{name} - [{method}] {url}".format(name=self.request_name, method=self.request["method"], url=self.request["url"])
 
+    def prepare(self, env=None, middlewares=None, auth=None, runner_class=None, **kwargs):
+        """ Build the HistoryRunner, or runner_class, for a call to this request """
+        call_kwargs = self.kwargs.copy()
+        call_kwargs.update(**kwargs)
+        kwargs = call_kwargs
+
+        start = time.perf_counter()
+        env = env or self.env
+        url, kwargs, default_auth = self.plan.build(kwargs, env)
+        middleware = self.get_middleware(middlewares or self.middlewares)
+
+        runner = (runner_class or HistoryRunner)(
+            self.request, kwargs, env, middleware, auth or default_auth, url,
+            request_name=self.request_name,
+            folder_name=self.folder.META.folder_name if self.folder else None)
+        runner.prepare_time = time.perf_counter() - start
+        return runner
+
     def __call__(self, env=None, middlewares=None, auth=None, **kwargs):
-        global R, H, J, D
+        global R
 
-        kwargs = self.kwargs.copy()
-        kwargs.update(**kwargs)
+        runner = self.prepare(env=env, middlewares=middlewares, auth=auth, **kwargs)
 
-        request = self.request
-        request_name = self.request_name
-        folder = self.folder
-        env = env or self.env
-        middlewares = middlewares or self.middlewares
+        R = runner()
+        H.add_history_item(runner)
 
-        auth = auth or get_auth(request, env=env)
+        return R
 
-        kwargs = set_headers(request, kwargs, env=env)
+    async def _async(self, env=None, middlewares=None, auth=None, **kwargs):
+        """
+        Run the request on the asyncio event loop, ex: await P.folder.request._async()
+        Many requests can be run at once with asyncio.gather, sharing the connections of one client
+        per verify, cert and proxies.  Needs httpx.  Streaming and hooks are not supported, and the
+        response cache isn't used.
+        """
+        global R
 
-        url, full_url, kwargs = set_url(request, kwargs, env=env)
+        runner = self.prepare(env=env, middlewares=middlewares, auth=auth, runner_class=AsyncHistoryRunner, **kwargs)
 
-        kwargs = set_body(request, kwargs, env=env)
+        R = await runner()
+        H.add_history_item(runner)
 
-        middleware = get_middleware(folder, request_name, middlewares=middlewares)
+        return R
 
-        runner = HistoryRunner(request, kwargs, env, middleware, auth, url)
+    def _stream(self, path=None, env=None, middlewares=None, auth=None, **kwargs):
+        """
+        Run the request with stream=True, so the body is not read into memory.
+        Use iter_chunks, iter_json_items or iter_ndjson on the returned response to read it.
+        If path is given, the body is written to that file and the path is kept in the history.
+        """
+        global R
+
+        runner = self.prepare(env=env, middlewares=middlewares, auth=auth, stream=True, **kwargs)
 
         R = runner()
-        runner.results = R
-        runner.data = D
-        runner.json = J
+        if path is not None:
+            runner.body_path = save_stream(R, path)
         H.add_history_item(runner)
 
         return R
 
+    def _map(self, kwargs_list, concurrency=8, env=None, middlewares=None, auth=None):
+        """
+        Run the request once for each of the kwargs in kwargs_list, using a pool of
+        concurrency threads.  Returns the responses in the order of kwargs_list.
+        Every call that succeeded is added to the history in the order of kwargs_list, and R, J and D
+        are set from the last call.  If any call raised, the first error is raised once all have finished.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        runners = [self.prepare(env=env, middlewares=middlewares, auth=auth, **kwargs)
+                   for kwargs in kwargs_list]
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(runner, update_globals=False) for runner in runners]
+
+        results = []
+        error = None
+        for runner, future in zip(runners, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                error = error or e
+                continue
+            H.add_history_item(runner)
+        if error is not None:
+            raise error
+
+        if runners:
+            runners[-1].set_globals()
+        return results
+
+    def _iterate(self, data, sink=None, fields=(), concurrency=8, env=None, middlewares=None, auth=None):
+        """
+        Run the request once for each row of data, a CSV, JSON array or JSON lines file (see iter_data_rows)
+        or an iterable of dicts.  Each row's fields are layered over the environment for templating.
+        Rows are read as they are run, and the status, timings and the response fields at the dotted paths
+        in fields are written to sink (a .jsonl or .csv path, or a ResultSink) instead of the history.
+        Returns an IterationReport.
+        """
+        rows = iter_data_rows(data) if isinstance(data, str) else data
+        return run_iterations(self, rows, sink=sink, fields=fields, concurrency=concurrency, env=env,
+                              middlewares=middlewares, auth=auth)
+
 
 class History(object):
-    """Holds the history of the requests"""
-    def __init__(self):
+    """
+    Holds the history of the requests.
+    max_entries caps the number of entries kept, dropping the oldest.
+    max_body_bytes caps the response bytes held in memory. Past it the oldest
+    bodies are written to spill_dir, or dropped if there is no spill_dir,
+    while the request itself is kept so it can still be replayed.
+    """
+    def __init__(self, max_entries=None, max_body_bytes=None, spill_dir=None, store=None):
         self.history = []
+        self.store = store
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self.spill_dir = spill_dir
+        self.body_bytes = 0
+        # The items with a body in memory, oldest first
+        self.loaded = OrderedDict()
+        self.lock = threading.RLock()
 
     def __getitem__(self, key):
         return self.history.__getitem__(key)
@@ -362,15 +1215,280 @@ class History(object):
         if run is None:
             print(repr(self))
         else:
-            return H.history[run]()
+            item = self.history[run]
+            result = item()
+            if isinstance(item, AsyncHistoryRunner):
+                return self.track_async(item, result)
+            with self.lock:
+                self.track_body(item)
+            return result
+
+    async def track_async(self, item, result):
+        """ Await the replay of an async history item, then account for its body """
+        result = await result
+        with self.lock:
+            self.track_body(item)
+        return result
 
     def __repr__(self):
-        return "\n".join(["{0}: {1}".format(idx, hist.short_repr())
+        return "\n".join(["{0}: {1}{2}".format(idx, hist.short_repr(),
+                                               " ({:.1f}ms)".format(hist.timings.total * 1000)
+                                               if "total" in hist.timings else "")
                           for idx, hist in enumerate(self.history)])
 
+    def _stats(self, name=None):
+        """
+        Get the count, mean and percentiles of each timing phase, per folder.request.
+        name only includes the requests with that folder.request name.
+        """
+        histograms = OrderedDict()
+        with self.lock:
+            items = list(self.history)
+        for item in items:
+            item_name = item.get_name()
+            if not item.timings or (name is not None and item_name != name):
+                continue
+            phases = histograms.setdefault(item_name, OrderedDict())
+            for phase in TIMING_PHASES:
+                if phase in item.timings:
+                    phases.setdefault(phase, LatencyHistogram()).record(item.timings[phase])
+
+        stats = HistoryStats()
+        for item_name, phases in histograms.items():
+            stats[item_name] = O(**{phase: O(count=h.count, mean=h.mean(), p50=h.percentile(50),
+                                             p90=h.percentile(90), p99=h.percentile(99), max=h.max)
+                                    for phase, h in phases.items()})
+        return stats
+
     def add_history_item(self, item):
-        item.__doc__ = item._get_info()
-        self.history.append(item)
+        if self.store is not None:
+            self.store.add(item)
+        with self.lock:
+            self.history.append(item)
+            self.track_body(item)
+            if self.max_entries is not None and len(self.history) > self.max_entries:
+                dropped = self.history[:-self.max_entries]
+                del self.history[:-self.max_entries]
+                for old in dropped:
+                    self.loaded.pop(old, None)
+                    self.body_bytes -= old.tracked_bytes
+                    old.tracked_bytes = 0
+                    old.delete_spill()
+
+    def search(self, **filters):
+        """ Search the persisted history.  See HistoryStore.query for the filters """
+        if self.store is None:
+            raise ValueError("No history store set, set H.store = HistoryStore(path)")
+        return self.store.query(**filters)
+
+    def track_body(self, item):
+        """
+        Account for the item's body in the byte budget, evicting the oldest bodies past it.
+        The item itself is never evicted, so the budget is exceeded while its body alone is over it.
+        """
+        size = item.body_size()
+        self.body_bytes += size - item.tracked_bytes
+        if size and not item.tracked_bytes:
+            self.loaded[item] = None
+        elif not size:
+            self.loaded.pop(item, None)
+        item.tracked_bytes = size
+
+        if self.max_body_bytes is None:
+            return
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        for old in list(self.loaded):
+            if self.body_bytes <= self.max_body_bytes:
+                break
+            if old is item:
+                continue
+            del self.loaded[old]
+            old.evict_body(self.spill_dir)
+            self.body_bytes -= old.tracked_bytes
+            old.tracked_bytes = 0
+
+
+class HistoryStats(O):
+    """ The timing stats of the history, from H._stats() """
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        output = "{:<30} {:<10} {:>6} {:>9} {:>9} {:>9} {:>9}\n".format(
+            "Request", "Phase", "Count", "Mean", "p50", "p90", "p99")
+        for name, phases in self._to_dict().items():
+            for phase in TIMING_PHASES:
+                if phase not in phases:
+                    continue
+                stats = phases[phase]
+                output += "{:<30} {:<10} {:>6} {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms\n".format(
+                    name if phase == "total" else "", phase, stats.count, stats.mean * 1000,
+                    stats.p50 * 1000, stats.p90 * 1000, stats.p99 * 1000)
+        return output
+
+
+class HistoryStore(object):
+    """
+    Persists the history to a SQLite database, so it survives restarts.
+    Items are written by a background thread so requests aren't slowed down,
+    and bodies are only read from the database when a loaded entry's data is accessed.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp REAL,
+            method TEXT,
+            url TEXT,
+            status_code INTEGER,
+            folder_name TEXT,
+            request_name TEXT,
+            request TEXT,
+            kwargs TEXT,
+            env TEXT,
+            auth TEXT,
+            body_path TEXT,
+            body BLOB
+        );
+        CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp);
+        CREATE INDEX IF NOT EXISTS history_method ON history (method);
+        CREATE INDEX IF NOT EXISTS history_url ON history (url);
+        CREATE INDEX IF NOT EXISTS history_status_code ON history (status_code);
+        CREATE INDEX IF NOT EXISTS history_name ON history (folder_name, request_name);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+        self.writer = threading.Thread(target=self.write_loop, name="HistoryStore", daemon=True)
+        self.writer.start()
+        # The writer is a daemon thread, so write what is still queued when the interpreter exits
+        atexit.register(self.close)
+
+    def connect(self):
+        import sqlite3
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add(self, item):
+        """
+        Queue the history item to be written.  Only shallow copies of the env and auth are taken here,
+        they are converted to JSON by the writer thread.
+        """
+        auth = dict(get_o_dict(item.auth)) if isinstance(item.auth, O) else None
+        env = dict(get_o_dict(item.env)) if isinstance(item.env, O) else None
+        self.queue.put((item.timestamp or time.time(), item.request["method"], item.url, item.status_code,
+                        item.folder_name, item.request_name, item.request, item.kwargs.copy(), env, auth,
+                        item.body_path, item._data))
+
+    def write_loop(self):
+        conn = self.connect()
+        stop = False
+        while not stop:
+            rows = [self.queue.get()]
+            # Write everything that is waiting in a single transaction
+            while True:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in rows
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO history (timestamp, method, url, status_code, folder_name, request_name, "
+                        "request, kwargs, env, auth, body_path, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [self.encode(row) for row in rows if row is not None])
+            except Exception as e:
+                print("Could not write history: ", e)
+            for _ in rows:
+                self.queue.task_done()
+        conn.close()
+
+    def encode(self, row):
+        """ JSON encode the request, kwargs, env and auth of a queued row """
+        encoded = tuple(json.dumps(to_plain(x, copy_leaves=False), default=str) for x in row[6:10])
+        return row[:6] + encoded + row[10:]
+
+    def flush(self):
+        """ Wait for all queued items to be written """
+        self.queue.join()
+
+    def close(self):
+        """ Write the queued items and stop the writer thread """
+        atexit.unregister(self.close)
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+
+    def query(self, method=None, url=None, status=None, since=None, until=None,
+              folder=None, request=None, limit=100):
+        """
+        Get the persisted history items, newest first.
+        url is a glob pattern, ex: */users/*.  since and until are datetimes or timestamps.
+        """
+        self.flush()
+        where, args = [], []
+        if method is not None:
+            where.append("method = ?")
+            args.append(method.upper())
+        if url is not None:
+            where.append("url GLOB ?")
+            args.append(url)
+        if status is not None:
+            where.append("status_code = ?")
+            args.append(status)
+        if since is not None:
+            where.append("timestamp >= ?")
+            args.append(since.timestamp() if hasattr(since, "timestamp") else since)
+        if until is not None:
+            where.append("timestamp <= ?")
+            args.append(until.timestamp() if hasattr(until, "timestamp") else until)
+        if folder is not None:
+            where.append("folder_name = ?")
+            args.append(folder)
+        if request is not None:
+            where.append("request_name = ?")
+            args.append(request)
+
+        sql = ("SELECT id, timestamp, url, status_code, folder_name, request_name, request, kwargs, env, auth, "
+               "body_path FROM history")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        args.append(limit)
+
+        with contextlib.closing(self.connect()) as conn:
+            return [self.load_item(row) for row in conn.execute(sql, args)]
+
+    def load_item(self, row):
+        """ Build a replayable HistoryRunner from a history row """
+        row_id, timestamp, url, status_code, folder_name, request_name, request, kwargs, env, auth, body_path = row
+        auth = json.loads(auth)
+        env = json.loads(env)
+        item = HistoryRunner(json.loads(request),
+                             json.loads(kwargs),
+                             new_recursive(**env) if env is not None else E,
+                             get_named_middleware(folder_name, request_name or ""),
+                             new_recursive(**auth) if auth else None,
+                             url,
+                             request_name=request_name,
+                             folder_name=folder_name)
+        item.status_code = status_code
+        item.timestamp = timestamp
+        item.body_path = body_path
+        item.body_loader = lambda: self.load_body(row_id)
+        return item
+
+    def load_body(self, row_id):
+        """ Read the body of a history row """
+        with contextlib.closing(self.connect()) as conn:
+            row = conn.execute("SELECT body FROM history WHERE id = ?", (row_id,)).fetchone()
+        return row[0] if row else None
+
 
 """Holds the middleware"""
 MW = O()
@@ -398,12 +1516,22 @@ def load_middleware(path):
     return middlewares
 
 
-def load_collection(path, merge=None):
-    """ Load the collection file at the given path, and return the requests"""
+def load_collection(path, merge=None, cache_dir=None):
+    """
+    Load the collection file (Postman v1, v2 or v2.1) at the given path, and return the requests.
+    The file is streamed, and the saved example responses are skipped without being parsed.
+    If cache_dir (or COLLECTION_CACHE_DIR) is set the parsed collection file is cached there,
+    and reused while the file is unchanged.
+    """
+    cache_dir = cache_dir or COLLECTION_CACHE_DIR
     if isinstance(path, str):
         path = open(path)
-    coll = json.load(path)
-    path.close()
+    if cache_dir and getattr(path, "name", None):
+        path.close()
+        coll = load_cached_json(path.name, cache_dir, skip=COLLECTION_SKIP_KEYS)
+    else:
+        coll = load_json_stream(path, skip=COLLECTION_SKIP_KEYS)
+        path.close()
     parsed = parse_requests(coll)
     if merge is None:
         return parsed
@@ -413,6 +1541,228 @@ def load_collection(path, merge=None):
         return merge
 
 
+"""Holds the directory collection files are cached in, if set"""
+COLLECTION_CACHE_DIR = None
+
+"""Holds the keys of the saved example responses, which are skipped when loading a collection"""
+COLLECTION_SKIP_KEYS = frozenset(["response", "responses"])
+
+
+class JsonStream(object):
+    """
+    Reads a JSON document from a file a chunk at a time, so that it can be parsed a value at a time.
+    Values can be skipped without parsing them, and only the value being read is held in memory.
+    """
+    FILLER = re.compile(r'[^"\[\]{}]*')
+    STRING = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+    SCALAR = re.compile(r'[^\s,:\]}]+')
+    WHITESPACE = re.compile(r'\s*')
+
+    def __init__(self, f, chunk_size=65536, encoding="utf-8"):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder(encoding)()
+        self.buffer = ""
+        self.pos = 0
+
+    def read(self):
+        """ Read the next chunk onto the buffer, dropping what was already read.  False at the end of the file """
+        # Read as much as is held, so that a long value is read in a few chunks rather than copied for each one
+        size = max(self.chunk_size, len(self.buffer) - self.pos)
+        chunk = self.f.read(size)
+        while isinstance(chunk, bytes):
+            text = self.text_decoder.decode(chunk, final=not chunk)
+            # Read on if the chunk ended partway through a character
+            chunk = text if text or not chunk else self.f.read(size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Get the next character after any whitespace, or "" at the end of the file """
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.read():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        """ Read the next character, which must be one of chars """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of {!r} but found {!r}".format(chars, char))
+        self.pos += 1
+        return char
+
+    def find_end(self, keep=True, limit=None):
+        """
+        Find the end of the next value, reading more of the file as needed.  Unless keep is set the value is
+        dropped from the buffer as it is read.  Returns None if the value is longer than limit.
+        """
+        char = self.peek()
+        if char not in "[{\"":
+            while True:
+                end = self.SCALAR.match(self.buffer, self.pos)
+                # A number at the end of the buffer may still have more digits to come
+                if end is None or end.end() < len(self.buffer) or not self.read():
+                    return end.end() if end else self.pos
+
+        depth = 0
+        pos = self.pos
+        in_string = False
+        while True:
+            # Only the strings and brackets are looked at one by one, the rest is matched by the regexes
+            while pos < len(self.buffer):
+                if not in_string:
+                    pos = self.FILLER.match(self.buffer, pos).end()
+                    if pos == len(self.buffer):
+                        break
+                    if self.buffer[pos] != '"':
+                        depth += 1 if self.buffer[pos] in "[{" else -1
+                        pos += 1
+                        if depth == 0:
+                            return pos
+                        continue
+                    in_string = True
+                    pos += 1
+                try:
+                    # The json module is quicker, but can only scan to the end of a string
+                    pos = json.decoder.scanstring(self.buffer, pos)[1]
+                except ValueError:
+                    # The string goes on in the next chunk, match what there is of it so it isn't scanned again
+                    pos = self.STRING.match(self.buffer, pos).end()
+                    # A backslash is only left unmatched when the chunk ends partway through its escape
+                    if pos == len(self.buffer) or self.buffer[pos] == "\\":
+                        break
+                    pos += 1
+                in_string = False
+                if depth == 0:
+                    return pos
+
+            if limit is not None and pos - self.pos > limit:
+                return None
+            if not keep:
+                self.pos = pos
+            offset = pos - self.pos
+            if not self.read():
+                raise ValueError("JSON document was not terminated")
+            pos = self.pos + offset
+
+    def value(self):
+        """ Parse the next value """
+        end = self.find_end()
+        value = json.loads(self.buffer[self.pos:end])
+        self.pos = end
+        return value
+
+    def skip(self):
+        """ Skip the next value without parsing it """
+        self.pos = self.find_end(keep=False)
+
+    def iter_object(self):
+        """ Iterate the keys of the next object.  The caller reads or skips the value of each key """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def iter_array(self):
+        """ Iterate the next array.  The caller reads or skips each item """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(",]") == "]":
+                return
+
+
+def load_json_stream(f, skip=(), chunk_size=65536):
+    """
+    Load the JSON document from the file f, a chunk at a time, leaving out the values of the object keys in skip.
+    The skipped values are never parsed, so a document that is mostly skipped is loaded in about the memory
+    of what is kept.  Values small enough to hold the skipped keys are searched for them, and parsed whole if
+    they have none.
+    """
+    stream = JsonStream(f, chunk_size=chunk_size)
+    skip_keys = tuple('"{}"'.format(key) for key in skip)
+
+    def read_value():
+        char = stream.peek()
+        if char not in "[{":
+            return stream.value()
+        end = stream.find_end(limit=chunk_size)
+        if end is not None:
+            text = stream.buffer[stream.pos:end]
+            if not any(key in text for key in skip_keys):
+                stream.pos = end
+                return json.loads(text)
+        if char == "[":
+            return [read_value() for _ in stream.iter_array()]
+        value = {}
+        for key in stream.iter_object():
+            if key in skip:
+                stream.skip()
+            else:
+                value[key] = read_value()
+        return value
+
+    value = read_value()
+    if stream.peek():
+        raise ValueError("Extra data after the JSON document")
+    return value
+
+
+def load_cached_json(path, cache_dir, skip=()):
+    """
+    Load the JSON file at the given path, using the cached parse in cache_dir if the file hasn't changed.
+    The file is unchanged if its mtime and size match, or if they don't, if its hash matches.
+    The values of the object keys in skip are left out, as in load_json_stream.
+    """
+    import hashlib
+    import tempfile
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    cache_path = os.path.join(cache_dir, hashlib.sha256(path.encode("utf-8")).hexdigest() + ".cache")
+
+    cached = None
+    try:
+        with open(cache_path, "rb") as f:
+            cached = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    if cached is not None and cached["mtime"] == stat.st_mtime and cached["size"] == stat.st_size:
+        return cached["data"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    if cached is not None and cached["hash"] == digest:
+        data = cached["data"]
+    else:
+        with open(path, "rb") as f:
+            data = load_json_stream(f, skip=skip)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, "wb") as f:
+        marshal.dump({"mtime": stat.st_mtime, "size": stat.st_size, "hash": digest, "data": data}, f)
+    os.replace(tmp_path, cache_path)
+    return data
+
+
 def load_environment(path, merge=None):
     """ Load the environment file at the given path, and return the env data"""
     if isinstance(path, str):
@@ -425,20 +1775,51 @@ def load_environment(path, merge=None):
     return merge
 
 
-def parse_args():
-    """ Parse command line args """
-    parser = argparse.ArgumentParser(description='Postman Repl')
-
+def add_load_args(parser):
+    """ Add the args for loading the collection, environment and middleware """
     parser.add_argument('collection_path', type=open, metavar='Collection',
                     help='The path to the postman collection file')
 
     parser.add_argument('--env', '-e', dest='env_path', type=open,
                     help='The path to a Postman environment file')
 
+    parser.add_argument('--globals', '-g', dest='globals_path', type=open,
+                    help='The path to a Postman globals file, the environment is layered over it')
+
     parser.add_argument('--middleware', '-m', dest='middleware_path',
                     help='The path to a middleware file')
 
-    args = parser.parse_args()
+    parser.add_argument('--cache-dir', dest='cache_dir',
+                    help='A directory to cache parsed collection files in')
+
+    parser.add_argument('--record', dest='record_path',
+                    help='Record every request and response to this cassette file')
+
+    parser.add_argument('--replay', dest='replay_path',
+                    help='Serve responses from this cassette file instead of the network')
+
+    parser.add_argument('--prometheus', dest='prometheus_path',
+                    help='Write request metrics to this Prometheus text format file')
+
+    parser.add_argument('--statsd', dest='statsd_address', metavar='HOST:PORT',
+                    help='Send request metrics to StatsD at this address over UDP')
+
+    parser.add_argument('--spans', dest='spans_path',
+                    help='Write a span for every request to this JSON lines file')
+
+    parser.add_argument('--verbosity', '-v', choices=RequestLog.LEVELS,
+                    help='How much of each request to log before it is sent')
+
+
+def parse_args(argv=None):
+    """ Parse command line args """
+    parser = argparse.ArgumentParser(description='Postman Repl')
+    add_load_args(parser)
+
+    parser.add_argument('--history', dest='history_path',
+                    help='The path to a SQLite file to persist the history in')
+
+    args = parser.parse_args(argv)
 
     if not args.collection_path:
         print("Must suppy a collection path")
@@ -447,9 +1828,131 @@ def parse_args():
     return args
 
 
+def load_args(args):
+    """ Load the environment, middleware and collection from the parsed args into the globals """
+    global E, P, MW, COLLECTION_CACHE_DIR
+
+    if args.cache_dir:
+        COLLECTION_CACHE_DIR = args.cache_dir
+    if args.verbosity:
+        LOG.level = args.verbosity
+    if args.record_path:
+        CASSETTE.record(args.record_path)
+    elif args.replay_path:
+        CASSETTE.replay(args.replay_path)
+    if args.prometheus_path:
+        INSTRUMENTS.add(PrometheusExporter(args.prometheus_path))
+    if args.statsd_address:
+        host, _, port = args.statsd_address.rpartition(":")
+        INSTRUMENTS.add(StatsdExporter(host or "127.0.0.1", int(port)))
+    if args.spans_path:
+        INSTRUMENTS.add(SpanExporter(args.spans_path))
+    if args.globals_path:
+        E = ChainO(load_environment(args.globals_path))
+    if args.env_path:
+        E = load_environment(args.env_path, merge=E if args.globals_path else None)
+    # Middleware must be loaded before the collection, as the requests hold onto MW
+    if args.middleware_path:
+        MW = load_middleware(args.middleware_path)
+    P = load_collection(args.collection_path)
+
+
+class TemplateCache(object):
+    """
+    Bounded LRU cache of compiled jinja templates, keyed by the template source.
+    Also holds the render context for each environment, which is reused until
+    the environment is modified.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.templates = OrderedDict()
+        self.contexts = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get_template(self, source):
+        """ Get the compiled template for the source, compiling it on a miss """
+        with self.lock:
+            template = self.templates.get(source)
+            if template is not None:
+                self.hits += 1
+                self.templates.move_to_end(source)
+                return template
+            self.misses += 1
+
+        from jinja2 import Template
+        template = Template(source)
+
+        with self.lock:
+            self.templates[source] = template
+            while len(self.templates) > self.maxsize:
+                self.templates.popitem(last=False)
+        return template
+
+    def get_context(self, env):
+        """
+        Get the render context for the env, a ChainMap rebuilt only if the env changed.
+        The context of a ChainO is its own keys chained over the contexts of its parents,
+        so only the keys of its own layer are copied.
+        """
+        version = env._version()
+        with self.lock:
+            cached = self.contexts.get(env)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        if isinstance(env, ChainO) and not env._deleted():
+            maps = [env.__dict__.copy()]
+            for parent in env._parents():
+                maps.extend(self.get_context(parent).maps)
+            context = ChainMap(*maps)
+        else:
+            context = ChainMap(env._to_dict())
+        with self.lock:
+            self.contexts[env] = (version, context)
+        return context
+
+    def clear(self):
+        """ Drop all cached templates and contexts, and reset the counters """
+        with self.lock:
+            self.templates.clear()
+            self.contexts.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """ Get the cache statistics """
+        return O(hits=self.hits, misses=self.misses,
+                 size=len(self.templates), maxsize=self.maxsize)
+
+    def __repr__(self):
+        return "TemplateCache(hits={hits}, misses={misses}, size={size}, maxsize={maxsize})".format(
+            **self.info()._to_dict())
+
+
+"""Holds the compiled templates used by env_replace"""
+TEMPLATE_CACHE = TemplateCache()
+
+
 def env_replace(data, env):
     """Template the text data with the environment data"""
-    return Template(data).render(**env._to_dict())
+    if "{" not in data:
+        # No template syntax, skip jinja but keep its newline handling
+        if "\r" in data:
+            data = data.replace("\r\n", "\n").replace("\r", "\n")
+        return data[:-1] if data.endswith("\n") else data
+    template = TEMPLATE_CACHE.get_template(data)
+    return render_template(template, TEMPLATE_CACHE.get_context(env))
+
+
+def render_template(template, context):
+    """ Render the template with the ChainMap context, which template.render would copy into a new dict first """
+    ctx = template.new_context(ChainMap(*context.maps, template.globals), shared=True)
+    try:
+        return template.environment.concat(template.root_render_func(ctx))
+    except Exception:
+        template.environment.handle_exception()
 
 def set_headers(request, kwargs, env=None):
     """ Set the request headers onto the kwargs for the request """
@@ -487,7 +1990,7 @@ def set_url(request, kwargs, env=None):
         else:
             params[k] = ""
 
-    if params and "params" in kwargs:
+    if kwargs.get("params"):
         params.update(kwargs["params"])
 
     kwargs["params"] = params
@@ -495,7 +1998,7 @@ def set_url(request, kwargs, env=None):
     if kwargs["params"]:
         full_url = url + '?'
         for k, v in kwargs["params"].items():
-            full_url = full_url + "&" + k + "=" + v
+            full_url = full_url + "&" + k + "=" + str(v)
     else:
         full_url = url
 
@@ -519,28 +2022,152 @@ def set_body(request, kwargs, env=None):
     elif 'data' in kwargs and isinstance(kwargs['data'], O):
         kwargs["data"] = kwargs["data"]._to_dict()
     elif 'json' in kwargs and isinstance(kwargs['json'], O):
-        kwargs["json"] = kwargs["json"]._to_dict()
+        kwargs["json"] = kwargs["json"]._to_dict_recursive(copy_leaves=False)
     return kwargs
 
 
 def get_middleware(folder, request_name, middlewares=None):
     """ Gets the middleware for the given folder + request """
+    folder_name = folder.META.folder_name if folder else None
+    return get_named_middleware(folder_name, request_name, middlewares=middlewares)
+
+
+def get_named_middleware(folder_name, request_name, middlewares=None):
+    """ Gets the middleware for the given folder name + request name """
     middlewares = middlewares or MW
-    if folder:
-        middleware = middlewares[folder.META.folder_name + "_" + request_name]
+    if folder_name:
+        middleware = middlewares[folder_name + "_" + request_name]
     else:
         middleware = middlewares[request_name]
 
     if middleware is None:
-        def default_middleware(run, kwargs, env):
-            return run(kwargs)
         middleware = default_middleware
 
     return middleware
 
 
+def default_middleware(run, kwargs, env):
+    """ The middleware for requests without one, runs the request unchanged """
+    return run(kwargs)
+
+
+class RequestPlan(object):
+    """
+    A request compiled once for its Runner: the headers split, the auth fields resolved
+    and every templated string (url, header values, body, auth fields) kept as a slot.
+    The rendered slots are kept per env, and a slot is only rendered again when a variable it reads changes.
+    """
+    def __init__(self, request):
+        self.request = request
+        self.auth_type = request.get("currentHelper")
+        auth_data = request.get("helperAttributes") or {}
+
+        headers = []
+        for split in request["headers"].split("\n"):
+            if not split:
+                continue
+            name, _, val = split.partition(":")
+            headers.append((name.strip(), val.strip()))
+        self.header_names = tuple(name for name, _ in headers)
+
+        self.body = request.get("rawModeData")
+        self.auth_fields = AUTH_FIELDS.get(self.auth_type, ())
+
+        sources = [request["url"]] + [val for _, val in headers]
+        if self.body:
+            sources.append(self.body)
+        sources.extend(auth_data[attr] for _, attr in self.auth_fields)
+
+        # Each slot is (source, variables read), variables is None if the source is not a template
+        self.slots = tuple((source, get_template_variables(source) if "{" in source else None)
+                           for source in sources)
+        self.static = [None if variables is not None else env_replace(source, None)
+                       for source, variables in self.slots]
+        self.rendered = weakref.WeakKeyDictionary()
+        self.url = None
+        self.lock = threading.Lock()
+
+    def render(self, env):
+        """ Get the rendered slots for the env """
+        version = env._version()
+        with self.lock:
+            cached = self.rendered.get(env)
+        if cached is not None and cached[0] == version:
+            return cached[2]
+
+        context = TEMPLATE_CACHE.get_context(env)
+        values = []
+        rendered = []
+        for i, (source, variables) in enumerate(self.slots):
+            if variables is None:
+                values.append(None)
+                rendered.append(self.static[i])
+                continue
+            current = tuple(context.get(name) for name in variables)
+            values.append(current)
+            if cached is not None and cached[1][i] == current and \
+                    all(type(v) in ATOMIC_TYPES for v in current):
+                rendered.append(cached[2][i])
+            else:
+                rendered.append(env_replace(source, env))
+
+        with self.lock:
+            self.rendered[env] = (version, values, rendered)
+        return rendered
+
+    def parse_url(self, url, env):
+        """ Split the rendered url into the url without the query, and its params """
+        cached = self.url
+        if cached is not None and cached[0] == url:
+            return cached[1], dict(cached[2])
+
+        parsed_url = urlparse(url)
+        base, _, _ = parsed_url.geturl().partition('?')
+        params = []
+        for k, v in parse_qs(parsed_url.query).items():
+            # TODO: Support parameter arrays?
+            params.append((k, v[0] if v else ""))
+        if not any("{" in v for _, v in params):
+            self.url = (url, base, tuple(params))
+        return base, {k: env_replace(v, env) if v else "" for k, v in params}
+
+    def build(self, kwargs, env):
+        """ Set the headers, params and body on the kwargs, returning the url, the kwargs and the auth """
+        rendered = self.render(env)
+        slots = iter(rendered)
+
+        url, params = self.parse_url(next(slots), env)
+        if kwargs.get("params"):
+            params.update(kwargs["params"])
+        kwargs["params"] = params
+
+        headers = dict(zip(self.header_names, slots))
+        if 'headers' in kwargs:
+            headers.update(kwargs["headers"])
+        kwargs["headers"] = headers
+
+        body = next(slots) if self.body else None
+        if not 'data' in kwargs and not 'json' in kwargs:
+            kwargs["data"] = body if self.body else get_default_request_data(self.request, env=env)
+        else:
+            kwargs = set_body(self.request, kwargs, env=env)
+
+        if self.auth_fields:
+            auth = O(type=self.auth_type, **{field: value for (field, _), value in zip(self.auth_fields, slots)})
+        else:
+            auth = get_auth(self.request, env=env)
+
+        return url, kwargs, auth
+
+
 def make_docstring(request, folder, method):
     """ Makes a docstring for the given request method """
+    method.__doc__ = build_docstring(request, folder)
+    return method
+
+
+def build_docstring(request, folder):
+    """ Builds the docstring for the given request """
     if folder:
         docstring = folder.META.folder_name.title() + " / " + request["name"] + ":\n"
 
@@ -560,90 +2187,988 @@ def make_docstring(request, folder, method):
     if auth:
         docstring += "\nDefault Auth Data:\n{auth}".format(auth=auth._pformat())
 
-    method.__doc__ = docstring
-    return method
+    return docstring
 
 
-def do_no_auth_request(request, url, **kwargs):
-    """Makes a normal request"""
-    print("Making Request: ")
-    print("METHOD: ", request["method"])
-    print("URL: ", url)
-    print("Params: ", json.dumps(kwargs.get("params")))
-    print("Headers: ", json.dumps(kwargs.get("headers")))
-    print("Data: \n", kwargs.get("data"))
+def get_ssl_context(verify=None, cert=None):
+    """
+    Build the SSL context for requests' verify and cert, for httpx.
+    verify is True/None, False to skip verifying or the path of a CA bundle or directory.
+    cert is the path of the client certificate, or a (certificate, key) tuple.
+    """
+    import ssl
+    if isinstance(verify, str):
+        context = ssl.create_default_context(**{"capath" if os.path.isdir(verify) else "cafile": verify})
+    else:
+        import certifi
+        context = ssl.create_default_context(cafile=certifi.where())
+    if verify is False:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if cert is not None:
+        context.load_cert_chain(*((cert,) if isinstance(cert, str) else cert))
+    return context
 
-    return requests.request(request["method"], url, **kwargs)
 
+class SessionManager(object):
+    """
+    Holds pooled keep-alive sessions, so that requests reuse their connections
+    instead of paying for a new TCP/TLS handshake every time.
+    Sessions are kept per host, or per environment when scope="env".  Environment sessions are
+    held weakly by the environment, and closed when it is garbage collected.
+    """
+    def __init__(self, scope="host", pool_size=10, max_idle=60, persist_cookies=False, async_connections=1000):
+        self.scope = scope
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self.persist_cookies = persist_cookies
+        self.async_connections = async_connections
+        self.sessions = weakref.WeakKeyDictionary() if scope == "env" else {}
+        self.async_clients = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get_key(self, url, env=None):
+        """ Get the key the session for the url/env is stored under """
+        if self.scope == "env":
+            return env or E
+        parsed_url = urlparse(url)
+        return (parsed_url.scheme, parsed_url.netloc)
+
+    def new_session(self):
+        """ Create a new session with a connection pool of pool_size """
+        from http.cookiejar import DefaultCookiePolicy
+        import requests
+        session = requests.Session()
+        adapter = get_timed_adapter_class()(pool_connections=self.pool_size,
+                                            pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.persist_cookies:
+            # Behave like a one-off request, which never carries cookies over
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def get_session(self, url, env=None):
+        """ Get the pooled session for the url/env, replacing it if it sat idle too long """
+        key = self.get_key(url, env=env)
+        now = time.monotonic()
+        with self.lock:
+            session, last_used = self.sessions.get(key, (None, None))
+            if session is not None and self.max_idle is not None and now - last_used > self.max_idle:
+                session.close()
+                session = None
+            if session is None:
+                session = self.new_session()
+                if self.scope == "env":
+                    # The session must not hold onto the env, or it would never be collected
+                    weakref.finalize(key, session.close)
+            self.sessions[key] = (session, now)
+        return session
+
+    def get_async_client(self, verify=None, cert=None, proxies=None):
+        """
+        Get the httpx client for the running event loop, used by async requests.
+        Each loop has a client per verify/cert/proxies, which take the same values as for requests.
+        A client holds up to async_connections connections, shared by all hosts.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if isinstance(cert, list):
+            cert = tuple(cert)
+        key = (verify, cert, tuple(sorted((proxies or {}).items())))
+        clients = self.async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            from http.cookiejar import DefaultCookiePolicy
+            import httpx
+            limits = httpx.Limits(max_connections=self.async_connections,
+                                  max_keepalive_connections=self.async_connections,
+                                  keepalive_expiry=self.max_idle)
+            verify = get_ssl_context(verify, cert) if verify is not None or cert is not None else True
+            # requests' proxies are keyed by scheme, or scheme://host, which httpx takes as patterns
+            mounts = {
+                name if "://" in name else name + "://":
+                    httpx.AsyncHTTPTransport(proxy=url, verify=verify, limits=limits) if url else None
+                for name, url in (proxies or {}).items()}
+            client = httpx.AsyncClient(limits=limits, timeout=None, verify=verify, mounts=mounts)
+            if not self.persist_cookies:
+                client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            clients[key] = client
+        return client
+
+    async def aclose(self):
+        """ Close the async clients of the running event loop """
+        import asyncio
+        clients = self.async_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+    def close(self):
+        """ Close all of the pooled sessions """
+        with self.lock:
+            for session, _ in list(self.sessions.values()):
+                session.close()
+            self.sessions.clear()
 
-def do_custom_auth_request(request, url, auth_data, **kwargs):
-    """Makes a normal request"""
-    print("Making Request: ")
-    print("METHOD: ", request["method"])
-    print("URL: ", url)
-    print("Params: ", json.dumps(kwargs.get("params")))
-    print("Headers: ", json.dumps(kwargs.get("headers")))
-    print("Custom Auth Data: ", auth_data)
-    print("Data: \n", kwargs.get("data"))
+    def __repr__(self):
+        return "SessionManager(scope={}, pool_size={}, max_idle={}, sessions={})".format(
+            self.scope, self.pool_size, self.max_idle, len(self.sessions))
 
-    return requests.request(request["method"], url, **kwargs)
 
+"""Holds the pooled sessions used to make requests"""
+SESSIONS = SessionManager()
 
-def do_basic_auth_request(request, url, auth_data, **kwargs):
-    """Makes a normal request"""
-    from requests.auth import HTTPBasicAuth
-    auth = HTTPBasicAuth(auth_data.username, auth_data.password)
 
-    print("Making Request: ")
-    print("METHOD: ", request["method"])
-    print("URL: ", url)
-    print("Params: ", json.dumps(kwargs.get("params")))
-    print("Headers: ", json.dumps(kwargs.get("headers")))
-    print("Basic Auth Data: ", auth_data)
-    print("Data: \n", kwargs.get("data"))
+"""The phases a request's time is split into, in the order they happen"""
+TIMING_PHASES = ("total", "prepare", "middleware", "connect", "tls", "wait", "download", "client", "parse")
 
-    return requests.request(request["method"], url, auth=auth, **kwargs)
 
+class RequestTimer(threading.local):
+    """
+    The connect and TLS handshake time, and when the response headers arrived, for the request being sent
+    on this thread.  Recorded by the pooled sessions' adapter.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.connect = 0.0
+        self.tls = 0.0
+        self.headers = None
+
+
+"""Holds the timings of the request being sent on each thread"""
+REQUEST_TIMER = RequestTimer()
+
+"""The HTTPAdapter used by the pooled sessions, built on first use so requests isn't imported with the module"""
+TimedHTTPAdapter = None
+
+
+def get_timed_adapter_class():
+    """ Get the HTTPAdapter that records new connections' connect and TLS time into REQUEST_TIMER """
+    global TimedHTTPAdapter
+    if TimedHTTPAdapter is not None:
+        return TimedHTTPAdapter
+
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class TimedHTTPConnection(HTTPConnection):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                HTTPConnection.connect(self)
+            finally:
+                REQUEST_TIMER.connect += time.perf_counter() - start
+
+    class TimedHTTPSConnection(HTTPSConnection):
+        def _new_conn(self):
+            start = time.perf_counter()
+            try:
+                return HTTPSConnection._new_conn(self)
+            finally:
+                self.tcp_time = time.perf_counter() - start
+
+        def connect(self):
+            self.tcp_time = 0.0
+            start = time.perf_counter()
+            try:
+                HTTPSConnection.connect(self)
+            finally:
+                # The rest of the connect, after the TCP connection, is the TLS handshake
+                REQUEST_TIMER.connect += self.tcp_time
+                REQUEST_TIMER.tls += time.perf_counter() - start - self.tcp_time
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    class Adapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool,
+                                                       "https": TimedHTTPSConnectionPool}
+
+        def send(self, *args, **kwargs):
+            response = HTTPAdapter.send(self, *args, **kwargs)
+            REQUEST_TIMER.headers = time.perf_counter()
+            return response
+
+    TimedHTTPAdapter = Adapter
+    return TimedHTTPAdapter
+
+
+class ResponseCache(object):
+    """
+    HTTP cache for GET and HEAD responses, honouring Cache-Control and Expires.
+    Fresh responses are served without a request.  Stale responses with an ETag or
+    Last-Modified are revalidated with a conditional request, and served from the
+    cache on a 304.  Entries are kept in memory up to max_bytes of bodies, and past
+    that moved to cache_dir if it is set.
+    Disabled until enabled is set, ex: CACHE.enabled = True
+    """
+    METHODS = ("GET", "HEAD")
+
+    def __init__(self, enabled=False, max_bytes=64 * 1024 * 1024, cache_dir=None):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_key(self, method, url, kwargs, vary=None):
+        """ Hash the request into a cache key """
+        import hashlib
+        params = kwargs.get("params") or {}
+        headers = kwargs.get("headers") or {}
+        key = json.dumps([method, url, sorted(params.items()), sorted(headers.items()), vary],
+                         default=str, sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get_vary(auth):
+        """
+        Get what the cache key varies on for the request's auth, so credentials never share responses.
+        Auth objects are keyed by their type and attributes, and when those aren't plain values
+        False is returned and the request isn't cached.
+        """
+        if auth is None:
+            return None
+        if isinstance(auth, O):
+            return auth._to_dict()
+        attributes = getattr(auth, "__dict__", None)
+        if attributes is None or any(type(v) not in ATOMIC_TYPES for v in attributes.values()):
+            return False
+        return [type(auth).__module__, type(auth).__qualname__, sorted(attributes.items())]
+
+    @staticmethod
+    def get_cache_control(headers):
+        """ Parse a Cache-Control header into a dict of directive to value """
+        directives = {}
+        for part in (headers.get("Cache-Control") or "").split(","):
+            name, _, value = part.strip().partition("=")
+            if name:
+                directives[name.lower()] = value.strip('"')
+        return directives
+
+    @staticmethod
+    def get_expires(response, now):
+        """ Get the time the response stops being fresh, or None if it has no freshness information """
+        from email.utils import parsedate_to_datetime
+        cache_control = ResponseCache.get_cache_control(response.headers)
+        if "no-cache" in cache_control:
+            return None
+        age = 0
+        try:
+            age = int(response.headers.get("Age", 0))
+        except ValueError:
+            pass
+        if "max-age" in cache_control:
+            try:
+                return now + int(cache_control["max-age"]) - age
+            except ValueError:
+                return None
+        if response.headers.get("Expires"):
+            try:
+                expires = parsedate_to_datetime(response.headers["Expires"]).timestamp()
+                date = response.headers.get("Date")
+                date = parsedate_to_datetime(date).timestamp() if date else now
+                return now + expires - date
+            except (TypeError, ValueError, IndexError):
+                return None
+        return None
 
-def do_digest_auth_request(request, url, auth_data, **kwargs):
-    """Makes a normal request"""
-    from requests.auth import HTTPDigestAuth
-    auth = HTTPDigestAuth(auth_data.username, auth_data.password)
+    def get(self, key):
+        """ Get the entry from memory, or from disk promoting it to memory """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, key), "rb") as f:
+                entry = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        self.put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        """ Store the entry in memory, moving the least recently used entries to disk past max_bytes """
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old["content"])
+            self.entries[key] = entry
+            self.bytes += len(entry["content"])
+            while self.bytes > self.max_bytes and self.entries:
+                old_key, old = self.entries.popitem(last=False)
+                self.bytes -= len(old["content"])
+                evicted.append((old_key, old))
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for old_key, old in evicted:
+                with open(os.path.join(self.cache_dir, old_key), "wb") as f:
+                    marshal.dump(old, f)
+
+    def make_entry(self, response, now):
+        return {"status_code": response.status_code,
+                "reason": response.reason,
+                "url": response.url,
+                "encoding": response.encoding,
+                "headers": dict(response.headers),
+                "content": response.content,
+                "stored": now,
+                "expires": self.get_expires(response, now)}
+
+    @staticmethod
+    def make_response(entry):
+        """ Build a requests Response from a cache entry """
+        import datetime
+        from requests.models import Response
+        from requests.structures import CaseInsensitiveDict
+        response = Response()
+        response.status_code = entry["status_code"]
+        response.reason = entry["reason"]
+        response.url = entry["url"]
+        response.encoding = entry["encoding"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = entry["content"]
+        response.elapsed = datetime.timedelta(0)
+        return response
+
+    def fetch(self, method, url, kwargs, send, vary=None):
+        """
+        Get the response for the request from the cache, or by calling send with the kwargs.
+        Returns the response and how it was served: hit, revalidated, miss or None when it couldn't be cached.
+        """
+        from requests.structures import CaseInsensitiveDict
+        method = method.upper()
+        request_cache_control = self.get_cache_control(CaseInsensitiveDict(kwargs.get("headers") or {}))
+        if method not in self.METHODS or "no-store" in request_cache_control:
+            return send(kwargs), None
+
+        key = self.get_key(method, url, kwargs, vary=vary)
+        entry = self.get(key)
+        now = time.time()
+        if entry is not None and "no-cache" not in request_cache_control \
+                and entry["expires"] is not None and now < entry["expires"]:
+            with self.lock:
+                self.hits += 1
+            return self.make_response(entry), "hit"
+
+        send_kwargs = kwargs
+        if entry is not None:
+            # The entry's headers are a plain dict so they can be written to disk, but servers may use any case
+            entry_headers = CaseInsensitiveDict(entry["headers"])
+            headers = dict(kwargs.get("headers") or {})
+            if entry_headers.get("ETag"):
+                headers["If-None-Match"] = entry_headers["ETag"]
+            if entry_headers.get("Last-Modified"):
+                headers["If-Modified-Since"] = entry_headers["Last-Modified"]
+            send_kwargs = dict(kwargs, headers=headers)
+
+        response = send(send_kwargs)
+        if entry is not None and response.status_code == 304:
+            # Not modified, refresh the cached entry's headers and freshness
+            entry_headers.update(response.headers)
+            entry = dict(entry, headers=dict(entry_headers), stored=now)
+            entry["expires"] = self.get_expires(self.make_response(entry), now)
+            self.put(key, entry)
+            with self.lock:
+                self.revalidated += 1
+            return self.make_response(entry), "revalidated"
+
+        with self.lock:
+            self.misses += 1
+        cache_control = self.get_cache_control(response.headers)
+        storable = response.status_code == 200 and "no-store" not in cache_control and (
+            self.get_expires(response, now) is not None or
+            response.headers.get("ETag") or response.headers.get("Last-Modified"))
+        if storable:
+            self.put(key, self.make_entry(response, now))
+        return response, "miss"
+
+    def clear(self):
+        """ Drop every cached response, including those on disk """
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        if self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, name))
 
-    print("Making Request: ")
-    print("METHOD: ", request["method"])
-    print("URL: ", url)
-    print("Params: ", json.dumps(kwargs.get("params")))
-    print("Headers: ", json.dumps(kwargs.get("headers")))
-    print("Digest Auth Data: ", auth_data)
-    print("Data: \n", kwargs.get("data"))
+    def __repr__(self):
+        return "ResponseCache(enabled={}, hits={}, revalidated={}, misses={}, entries={}, bytes={})".format(
+            self.enabled, self.hits, self.revalidated, self.misses, len(self.entries), self.bytes)
 
-    return requests.request(request["method"], url, auth=auth, **kwargs)
 
+"""Holds the HTTP response cache, disabled by default"""
+CACHE = ResponseCache()
 
-def do_oauth1_request(request, url, auth_data, **kwargs):
-    """Makes a normal request"""
-    from requests_oauthlib import OAuth1
 
-    auth = OAuth1(auth_data.consumer_key,
-                  auth_data.consumer_secret,
-                  auth_data.access_token,
-                  auth_data.access_token_secret,
-                  signature_type='auth_header')
+def get_body_hash(kwargs):
+    """ Hash the body the request kwargs will send """
+    import hashlib
+    if kwargs.get("json") is not None:
+        body = json.dumps(kwargs["json"], sort_keys=True, default=str).encode("utf-8")
+    else:
+        body = kwargs.get("data")
+        if isinstance(body, dict):
+            body = json.dumps(body, sort_keys=True, default=str)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        elif not isinstance(body, bytes):
+            # Nothing, or a file, which isn't read to be matched
+            body = b""
+    return hashlib.sha256(body).hexdigest()
 
 
-    print("Making oAuth1 Request: ")
-    print("METHOD: ", request["method"])
-    print("URL: ", url)
-    print("Params: ", json.dumps(kwargs.get("params")))
-    print("Headers: ", json.dumps(kwargs.get("headers")))
-    print("OAuth1 Data: ", auth_data)
-    print("Data: \n", kwargs.get("data"))
+"""
+The ways a recorded request can be matched, by name.  Each gets the request as recorded
+(a dict of method, url, params and body hash), and returns the value to match on
+"""
+CASSETTE_MATCHERS = {
+    "method": lambda request: request["method"].upper(),
+    "url": lambda request: request["url"],
+    "params": lambda request: sorted(request["params"].items()),
+    "body": lambda request: request["body"],
+}
 
-    return requests.request(request["method"],
-                            url,
-                            auth=auth,
-                            **kwargs)
+
+class Cassette(object):
+    """
+    Records requests and their responses to a cassette file, or replays them from it without the network.
+    The cassette holds one JSON interaction per line.  A replayed request is matched on the
+    CASSETTE_MATCHERS named in match_on, which can also hold functions taking the recorded request.
+    Requests that match more than one recorded interaction get them in the order they were recorded.
+    Use CASSETTE.record(path), CASSETTE.replay(path) and CASSETTE.stop()
+    """
+    def __init__(self, match_on=("method", "url", "params", "body")):
+        self.match_on = match_on
+        self.mode = None
+        self.path = None
+        self.file = None
+        self.interactions = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_request(method, url, kwargs):
+        """ Get the request as it is recorded """
+        return {"method": method,
+                "url": url,
+                "params": {k: str(v) for k, v in (kwargs.get("params") or {}).items()},
+                "body": get_body_hash(kwargs)}
+
+    def get_key(self, request):
+        """ Get the values the recorded request is matched on """
+        key = []
+        for matcher in self.match_on:
+            if not callable(matcher):
+                matcher = CASSETTE_MATCHERS[matcher]
+            key.append(matcher(request))
+        return json.dumps(key, default=str)
+
+    def record(self, path):
+        """ Start recording to the cassette file at path, adding to it if it exists """
+        self.stop()
+        self.file = open(path, "a")
+        self.path = path
+        self.mode = "record"
+
+    def replay(self, path):
+        """ Start replaying the responses recorded in the cassette file at path """
+        self.stop()
+        interactions = {}
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    interaction = json.loads(line)
+                    key = self.get_key(interaction["request"])
+                    interactions.setdefault(key, deque()).append(interaction["response"])
+        self.interactions = interactions
+        self.path = path
+        self.mode = "replay"
+
+    def stop(self):
+        """ Stop recording or replaying """
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.path = None
+        self.mode = None
+        self.interactions = {}
+
+    def fetch(self, method, url, kwargs, send):
+        """ Get the response for the request from the cassette, or by calling send with the kwargs and recording it """
+        request = self.get_request(method, url, kwargs)
+        if self.mode == "replay":
+            key = self.get_key(request)
+            with self.lock:
+                responses = self.interactions.get(key)
+                if not responses:
+                    raise KeyError("No recorded response for [{}] {} in {}".format(method, url, self.path))
+                # The last recorded response is kept for any further calls
+                response = responses.popleft() if len(responses) > 1 else responses[0]
+            entry = dict(response)
+            if "body_base64" in response:
+                import base64
+                entry["content"] = base64.b64decode(response["body_base64"])
+            else:
+                entry["content"] = response["body"].encode("utf-8")
+            return ResponseCache.make_response(entry)
+
+        response = send(kwargs)
+        # Streamed bodies are read here so they can be recorded
+        content = response.content
+        recorded = {"status_code": response.status_code,
+                    "reason": response.reason,
+                    "url": response.url,
+                    "encoding": response.encoding,
+                    "headers": dict(response.headers),
+                    "elapsed": response.elapsed.total_seconds() if response.elapsed else None}
+        try:
+            recorded["body"] = content.decode("utf-8")
+        except UnicodeDecodeError:
+            import base64
+            recorded["body_base64"] = base64.b64encode(content).decode("ascii")
+        line = json.dumps({"request": request, "response": recorded},
+                          separators=(",", ":"))
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + "\n")
+                self.file.flush()
+        return response
+
+    def __repr__(self):
+        return "Cassette(mode={}, path={})".format(self.mode, self.path)
+
+
+"""Holds the record/replay cassette, off by default"""
+CASSETTE = Cassette()
+
+
+class Instruments(object):
+    """
+    Sends start and end events for every request to the exporters, ex: INSTRUMENTS.add(PrometheusExporter(path))
+    An exporter is any function taking the event O.  Events are handed to the exporters by a background thread,
+    so exporting never slows down a request.  If the exporters fall max_queue events behind, new events are dropped.
+    Each request run gives a "request" span, covering the middleware, and an "http" span inside it for each send.
+    """
+    def __init__(self, max_queue=10000):
+        self.exporters = []
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, exporter):
+        """ Add an exporter, starting the export thread on the first """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.export_loop, name="postman_repl-instruments", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+            self.exporters.append(exporter)
+        return exporter
+
+    def remove(self, exporter):
+        """ Remove the exporter, closing it """
+        self.flush()
+        with self.lock:
+            self.exporters.remove(exporter)
+        if hasattr(exporter, "close"):
+            exporter.close()
+
+    def start(self, kind, item, parent=None, elapsed=0.0):
+        """
+        Start a span of the kind for the HistoryRunner item, returning it to pass to end.
+        elapsed is how long ago the span started
+        """
+        span = O(kind=kind,
+                 name=item.get_name(),
+                 folder=item.folder_name,
+                 request=item.request_name,
+                 method=item.request["method"],
+                 url=item.url,
+                 trace_id=parent.trace_id if parent is not None else os.urandom(16).hex(),
+                 span_id=os.urandom(8).hex(),
+                 parent_span_id=parent.span_id if parent is not None else None,
+                 start=time.time() - elapsed)
+        self.emit(O(event="start", **span._to_dict()))
+        return span
+
+    def end(self, span, item, duration, error=None):
+        """ End the span, with the status, size and timings of the HistoryRunner item """
+        response = item.results
+        size = None
+        if response is not None and not item.kwargs.get("stream"):
+            size = len(getattr(response, "content", None) or b"")
+        elif response is not None and getattr(response, "headers", None) is not None:
+            size = int(response.headers.get("Content-Length") or 0) or None
+        self.emit(O(event="end",
+                    status=item.status_code if error is None else None,
+                    bytes=size,
+                    duration=duration,
+                    end=span.start + duration,
+                    timings=item.timings._to_dict() if span.kind == "request" else None,
+                    error="{}: {}".format(type(error).__name__, error) if error is not None else None,
+                    **span._to_dict()))
+
+    def emit(self, event):
+        """ Queue the event for the exporters, without blocking """
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def export_loop(self):
+        while True:
+            event = self.queue.get()
+            try:
+                for exporter in list(self.exporters):
+                    try:
+                        exporter(event)
+                    except Exception as e:
+                        sys.stderr.write("Exporter {} failed: {}\n".format(exporter, e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """ Wait for the queued events to be exported """
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        """ Export the queued events and close the exporters """
+        self.flush()
+        with self.lock:
+            exporters, self.exporters = self.exporters, []
+        for exporter in exporters:
+            if hasattr(exporter, "close"):
+                exporter.close()
+
+
+"""Holds the metrics and tracing exporters, none by default"""
+INSTRUMENTS = Instruments()
+
+
+class PrometheusExporter(object):
+    """
+    Writes request counts, a duration histogram and response bytes in the Prometheus text format,
+    for the node_exporter textfile collector.  The file is replaced at most every interval seconds, and on close.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.requests = {}
+        self.durations = {}
+        self.bytes = {}
+        self.written = 0.0
+
+    @staticmethod
+    def escape(value):
+        return str(value if value is not None else "").replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def __call__(self, event):
+        if event.event != "end" or event.kind != "request":
+            return
+        labels = 'folder="{}",request="{}",method="{}"'.format(
+            self.escape(event.folder), self.escape(event.request or event.url), self.escape(event.method))
+        status = labels + ',status="{}"'.format(event.status if event.error is None else "error")
+        self.requests[status] = self.requests.get(status, 0) + 1
+        counts, total = self.durations.get(labels, ([0] * (len(self.BUCKETS) + 1), 0.0))
+        for i, bucket in enumerate(self.BUCKETS):
+            if event.duration <= bucket:
+                counts[i] += 1
+        counts[-1] += 1
+        self.durations[labels] = (counts, total + event.duration)
+        if event.bytes:
+            self.bytes[labels] = self.bytes.get(labels, 0) + event.bytes
+        if time.monotonic() - self.written >= self.interval:
+            self.write()
+
+    def write(self):
+        """ Replace the metrics file with the current metrics """
+        lines = ["# HELP postman_repl_requests_total Requests run by postman_repl",
+                 "# TYPE postman_repl_requests_total counter"]
+        lines.extend("postman_repl_requests_total{{{}}} {}".format(labels, count)
+                     for labels, count in sorted(self.requests.items()))
+        lines.extend(["# HELP postman_repl_request_duration_seconds Request duration, including middleware",
+                      "# TYPE postman_repl_request_duration_seconds histogram"])
+        for labels, (counts, total) in sorted(self.durations.items()):
+            for bucket, count in zip(self.BUCKETS + ("+Inf",), counts):
+                lines.append('postman_repl_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bucket, count))
+            lines.append("postman_repl_request_duration_seconds_sum{{{}}} {}".format(labels, total))
+            lines.append("postman_repl_request_duration_seconds_count{{{}}} {}".format(labels, counts[-1]))
+        lines.extend(["# HELP postman_repl_response_bytes_total Response body bytes received",
+                      "# TYPE postman_repl_response_bytes_total counter"])
+        lines.extend("postman_repl_response_bytes_total{{{}}} {}".format(labels, size)
+                     for labels, size in sorted(self.bytes.items()))
+
+        # Write then rename, so the collector never reads a partial file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+        self.written = time.monotonic()
+
+    def close(self):
+        self.write()
+
+
+class StatsdExporter(object):
+    """
+    Sends request counts, durations and response bytes to StatsD over UDP, as
+    <prefix>.<folder>.<request>.requests, .status.<code>, .duration and .bytes
+    """
+    def __init__(self, host="127.0.0.1", port=8125, prefix="postman_repl"):
+        import socket
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    @staticmethod
+    def get_name(value):
+        return re.sub(r'[^A-Za-z0-9_-]', '_', value or "none")
+
+    def __call__(self, event):
+        if event.event != "end" or event.kind != "request":
+            return
+        name = "{}.{}.{}".format(self.prefix, self.get_name(event.folder), self.get_name(event.request or event.url))
+        metrics = ["{}.requests:1|c".format(name),
+                   "{}.status.{}:1|c".format(name, event.status if event.error is None else "error"),
+                   "{}.duration:{:.3f}|ms".format(name, event.duration * 1000)]
+        if event.bytes:
+            metrics.append("{}.bytes:{}|c".format(name, event.bytes))
+        try:
+            self.socket.sendto("\n".join(metrics).encode("utf-8"), self.address)
+        except OSError:
+            # Nothing listening, or the buffer is full, metrics are best effort
+            pass
+
+    def close(self):
+        self.socket.close()
+
+
+class SpanExporter(object):
+    """ Writes each finished span as an OpenTelemetry style JSON object, one per line """
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def __call__(self, event):
+        if event.event != "end":
+            return
+        attributes = {"http.method": event.method,
+                      "http.url": event.url,
+                      "http.status_code": event.status,
+                      "http.response_content_length": event.bytes,
+                      "postman.folder": event.folder,
+                      "postman.request": event.request}
+        if event.timings:
+            attributes.update(("postman.timings." + phase, seconds) for phase, seconds in event.timings.items())
+        span = {"traceId": event.trace_id,
+                "spanId": event.span_id,
+                "parentSpanId": event.parent_span_id,
+                "name": "{} {}".format(event.kind, event.name),
+                "kind": "CLIENT" if event.kind == "http" else "INTERNAL",
+                "startTimeUnixNano": int(event.start * 1e9),
+                "endTimeUnixNano": int(event.end * 1e9),
+                "attributes": {k: v for k, v in attributes.items() if v is not None},
+                "status": {"code": "ERROR", "message": event.error} if event.error else {"code": "OK"}}
+        self.file.write(json.dumps(span, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class RequestLog(object):
+    """
+    Logs each request before it is sent, at one of the levels:
+    silent logs nothing, summary logs the method and url, and full also logs the params, headers, auth and body.
+    Nothing is formatted unless the level logs it.  Bodies are cut to max_body characters,
+    and params, headers and auth fields whose names match secrets are logged as ***.
+    Logs to stream, or stdout if it isn't set. ex: LOG.level = "summary"
+    """
+    LEVELS = ("silent", "summary", "full")
+
+    def __init__(self, level="full", max_body=2048, stream=None,
+                 secrets=r'auth|token|secret|password|passwd|api[-_]?key|cookie|session'):
+        self.level = level
+        self.max_body = max_body
+        self.stream = stream
+        self.secrets = re.compile(secrets, re.I)
+
+    def redact(self, values):
+        """ Replace the values whose names look like secrets """
+        if not values:
+            return values
+        return {k: "***" if self.secrets.search(str(k)) else v for k, v in values.items()}
+
+    def format_body(self, body):
+        """ Format the body, cut to max_body """
+        if body is None:
+            return None
+        if isinstance(body, bytes):
+            text = body[:self.max_body].decode("utf-8", "replace") if self.max_body is not None else \
+                body.decode("utf-8", "replace")
+            size = len(body)
+        elif isinstance(body, str):
+            text, size = body, len(body)
+        elif isinstance(body, (O, dict, list)):
+            text = json.dumps(body, default=json_default)
+            size = len(text)
+        else:
+            # A file or generator, which can only be read once
+            return "<{}>".format(type(body).__name__)
+        if self.max_body is not None and size > self.max_body:
+            return text[:self.max_body] + "... ({} more)".format(size - self.max_body)
+        return text
+
+    def format_auth(self, auth):
+        """ Format the auth with its secrets hidden """
+        if not isinstance(auth, O):
+            return type(auth).__name__
+        return self.redact(auth._to_dict())
+
+    def log(self, method, url, kwargs, auth=None):
+        """ Log the request about to be sent """
+        if self.level == "silent":
+            return
+        if self.level not in self.LEVELS:
+            raise ValueError("LOG.level must be one of {}".format(", ".join(self.LEVELS)))
+
+        out = self.stream or sys.stdout
+        if self.level == "summary":
+            out.write("[{}] {}\n".format(method, url))
+            return
+
+        lines = ["Making Request: ",
+                 "METHOD:  {}".format(method),
+                 "URL:  {}".format(url),
+                 "Params:  {}".format(json.dumps(self.redact(kwargs.get("params")), default=str)),
+                 "Headers:  {}".format(json.dumps(self.redact(kwargs.get("headers")), default=str))]
+        if auth is not None:
+            lines.append("Auth Data:  {}".format(self.format_auth(auth)))
+        body = kwargs.get("json") if kwargs.get("json") is not None else kwargs.get("data")
+        lines.append("Data: \n {}".format(self.format_body(body)))
+        out.write("\n".join(lines) + "\n")
+
+
+"""Holds the request logging settings"""
+LOG = RequestLog()
+
+
+class AuthHandlerCache(object):
+    """
+    Keeps the auth handlers built for each request and its credentials, so they are reused by later
+    calls and history replays.  A reused digest handler remembers the server's challenge and its nonce
+    count, so after the first request it signs up front instead of taking a 401 and retrying.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.handlers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, kind, request, url, auth_data, build):
+        """
+        Get the kind (requests or httpx) of handler for the request and auth_data, calling build on a miss.
+        Requests without an id, like those made in scripts, are told apart by their url
+        """
+        request_id = request.get("id") if isinstance(request, dict) else request["id"]
+        key = (kind, request_id or url, tuple(sorted(auth_data._to_dict().items())))
+        with self.lock:
+            handler = self.handlers.get(key)
+            if handler is not None:
+                self.handlers.move_to_end(key)
+                return handler
+
+        handler = build(auth_data)
+        with self.lock:
+            handler = self.handlers.setdefault(key, handler)
+            while len(self.handlers) > self.maxsize:
+                self.handlers.popitem(last=False)
+        return handler
+
+    def clear(self):
+        with self.lock:
+            self.handlers.clear()
+
+    def __repr__(self):
+        return "AuthHandlerCache(size={}, maxsize={})".format(len(self.handlers), self.maxsize)
+
+
+"""Holds the auth handlers for the requests"""
+AUTH_HANDLERS = AuthHandlerCache()
+
+
+def build_requests_auth(auth_data):
+    """ Build the requests auth handler for the auth """
+    if auth_data.type == "basicAuth":
+        from requests.auth import HTTPBasicAuth
+        return HTTPBasicAuth(auth_data.username, auth_data.password)
+    elif auth_data.type == "digestAuth":
+        from requests.auth import HTTPDigestAuth
+        return HTTPDigestAuth(auth_data.username, auth_data.password)
+    elif auth_data.type == "oAuth1":
+        from requests_oauthlib import OAuth1
+        return OAuth1(auth_data.consumer_key,
+                      auth_data.consumer_secret,
+                      auth_data.access_token,
+                      auth_data.access_token_secret,
+                      signature_type='auth_header')
+    return None
+
+
+def get_requests_auth(auth_data, request=None, url=None):
+    """
+    Get the requests auth handler for the request's auth, reused from AUTH_HANDLERS when the request is given.
+    Custom auth is passed to requests as is
+    """
+    if auth_data is None:
+        return None
+    elif not isinstance(auth_data, O):
+        return auth_data
+    elif auth_data.type not in AUTH_FIELDS:
+        print("Attempting no auth request with unknown auth type", auth_data)
+        return None
+    elif request is None:
+        return build_requests_auth(auth_data)
+    return AUTH_HANDLERS.get("requests", request, url, auth_data, build_requests_auth)
+
+
+def send_request(request, url, auth_data=None, session=None, **kwargs):
+    """ Log and send the request, with the auth handler for auth_data """
+    import requests
+    LOG.log(request["method"], url, kwargs, auth_data)
+    return (session or requests).request(request["method"], url, auth=get_requests_auth(auth_data, request, url),
+                                         **kwargs)
+
+
+"""Maps each postman auth type to its (auth field, postman helper attribute) pairs"""
+AUTH_FIELDS = {
+    "oAuth1": (("consumer_key", "consumerKey"),
+               ("consumer_secret", "consumerSecret"),
+               ("access_token", "token"),
+               ("access_token_secret", "tokenSecret")),
+    "basicAuth": (("username", "username"),
+                  ("password", "password")),
+    "digestAuth": (("username", "username"),
+                   ("password", "password")),
+}
 
 
 def get_auth(request, env=None):
@@ -651,20 +3176,9 @@ def get_auth(request, env=None):
     env = env or E
     auth = request.get('currentHelper', None)
     auth_data = request.get('helperAttributes', {})
-    if auth == "oAuth1":
-        return O(type=auth,
-                 consumer_key=env_replace(auth_data['consumerKey'], env),
-                 consumer_secret=env_replace(auth_data['consumerSecret'], env),
-                 access_token=env_replace(auth_data['token'], env),
-                 access_token_secret=env_replace(auth_data['tokenSecret'], env))
-    elif auth == "basicAuth":
-        return O(type=auth,
-                 username=env_replace(auth_data['username'], env),
-                 password=env_replace(auth_data['password'], env))
-    elif auth == "digestAuth":
-        return O(type=auth,
-                 username=env_replace(auth_data['username'], env),
-                 password=env_replace(auth_data['password'], env))
+    if auth in AUTH_FIELDS:
+        return O(type=auth, **{field: env_replace(auth_data[attr], env)
+                               for field, attr in AUTH_FIELDS[auth]})
     elif auth is None or auth == "normal":
         return None
     else:
@@ -676,8 +3190,8 @@ def make_request(request, request_name, folder):
     """ Create a request that can be called from the repl """
     do_request = Runner(request, request_name, folder, E, MW)
 
+    # The docstring is built from the request when it is first looked at
     do_request.__name__ = request_name
-    do_request = make_docstring(request, folder, do_request)
 
     return do_request
 
@@ -700,16 +3214,110 @@ def fix_name(name):
     return name
 
 
+"""Maps the Postman v2 auth types to the v1 auth helpers"""
+V2_AUTH_TYPES = {
+    "basic": "basicAuth",
+    "digest": "digestAuth",
+    "oauth1": "oAuth1",
+    "noauth": "normal",
+}
+
+
+def get_v2_text(value):
+    """ Get the text of a v2 description or url, which may be a string or an object """
+    if isinstance(value, dict):
+        return value.get("content", value.get("raw", ""))
+    return value or ""
+
+
+def get_v2_auth(auth):
+    """ Get the v1 (currentHelper, helperAttributes) of a v2 auth object """
+    auth_type = auth.get("type")
+    attributes = auth.get(auth_type) or {}
+    if isinstance(attributes, list):
+        # v2.1 lists the attributes as key/value pairs
+        attributes = {attribute["key"]: attribute.get("value", "") for attribute in attributes}
+    return V2_AUTH_TYPES.get(auth_type, auth_type), attributes
+
+
+def make_v2_request(item, folder_id, auth):
+    """ Convert a v2 collection item into a v1 request, auth is the v2 auth it inherits from its folders """
+    request = item["request"]
+    if isinstance(request, str):
+        request = {"url": request}
+
+    headers = request.get("header") or []
+    if isinstance(headers, list):
+        headers = "".join("{}: {}\n".format(header["key"], header.get("value", ""))
+                          for header in headers if not header.get("disabled"))
+
+    body = request.get("body") or {}
+    mode = body.get("mode")
+    data = body.get(mode) if mode in ("urlencoded", "formdata") else []
+
+    auth = request.get("auth") or auth
+    current_helper, helper_attributes = get_v2_auth(auth) if auth else (None, {})
+
+    return {
+        "id": item.get("id") or item.get("_postman_id") or "{}/{}".format(folder_id, item["name"]),
+        "name": item["name"],
+        "description": get_v2_text(request.get("description") or item.get("description")),
+        "url": get_v2_text(request.get("url")),
+        "method": request.get("method", "GET"),
+        "headers": headers,
+        "dataMode": "raw" if mode in ("raw", None) else mode,
+        "rawModeData": body.get("raw") if mode == "raw" else None,
+        "data": [{"key": d["key"], "value": d.get("value", ""), "type": d.get("type", "text")}
+                 for d in data if not d.get("disabled")],
+        "currentHelper": current_helper,
+        "helperAttributes": helper_attributes,
+        "folder": folder_id,
+    }
+
+
+def parse_v2_items(items, parent, auth):
+    """
+    Parse the v2 collection items into the parent Folder, with the folders nested and the requests
+    in the order of the collection.
+    auth is the v2 auth the requests inherit when they don't set their own.
+    """
+    folder_id = parent.META.id if parent.META else None
+    for item in items:
+        name = fix_name(item["name"])
+        if "item" in item:
+            folder_name = name
+            folder = Folder(META=O(folder_name=folder_name,
+                                   id=item.get("id") or item.get("_postman_id") or folder_name,
+                                   name=item["name"],
+                                   description=get_v2_text(item.get("description"))))
+            parse_v2_items(item["item"], folder, item.get("auth", auth))
+            parent[folder_name] = folder
+        elif "request" in item:
+            parent[name] = make_request(make_v2_request(item, folder_id, auth), name, parent if parent.META else None)
+    return parent
+
+
 def parse_requests(coll):
-    """ Parse out the requests and folders from the collection file """
+    """ Parse out the requests and folders from the collection file, in the Postman v1, v2 or v2.1 format """
+    if "item" in coll:
+        return parse_v2_items(coll["item"], Folder(), coll.get("auth"))
+
     folders = Folder()
     if "folders" in coll:
         for folder in coll["folders"]:
             folder_name = fix_name(folder["name"])
             folders[folder_name] = Folder(META=O(folder_name=folder_name, **folder))
 
+    # Index the folders by request id, rather than searching every folder for every request
+    folder_index = {}
+    for key in folders:
+        folder = folders[key]
+        if folder.META and folder.META.order:
+            for request_id in folder.META.order:
+                folder_index.setdefault(request_id, folder)
+
     for request in coll["requests"]:
-        folder = get_request_folder(request, folders)
+        folder = folder_index.get(request["id"])
         request_name = fix_name(request["name"])
         if folder:
             folder[request_name] = make_request(request, request_name, folder)
@@ -719,17 +3327,710 @@ def parse_requests(coll):
     return folders
 
 
+def get_request(collection, name):
+    """ Get the request from the collection by its dotted name, ex: folder.request """
+    item = collection
+    for part in name.split("."):
+        item = item[fix_name(part)] if item is not None else None
+    if not isinstance(item, Runner):
+        raise KeyError("No request named {} in the collection".format(name))
+    return item
+
+
+def get_template_variables(text):
+    """ Get the names of the environment variables the template text uses """
+    if not isinstance(text, str) or "{" not in text:
+        return set()
+    from jinja2 import Environment, meta
+    try:
+        return meta.find_undeclared_variables(Environment().parse(text))
+    except Exception:
+        return set()
+
+
+def get_request_reads(request):
+    """ Get the environment variables the request's url, headers, body and auth read """
+    reads = set()
+    for key in ("url", "headers", "rawModeData"):
+        reads |= get_template_variables(request.get(key))
+    for value in (request.get("helperAttributes") or {}).values():
+        reads |= get_template_variables(value)
+    return reads
+
+
+def get_middleware_writes(middleware):
+    """
+    Get the environment variables a middleware sets, ex: env.token = ... or env["token"] = ...
+    Found by reading the middleware source, so anything set indirectly is missed.
+    """
+    import ast
+    import inspect
+    import textwrap
+    try:
+        tree = ast.parse(textwrap.dedent(inspect.getsource(middleware)))
+    except (OSError, TypeError, SyntaxError):
+        return set()
+
+    function = next((node for node in ast.walk(tree)
+                     if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda))), None)
+    if function is None or len(function.args.args) < 3:
+        return set()
+    env_name = function.args.args[2].arg
+
+    writes = set()
+    for node in ast.walk(function):
+        targets = node.targets if isinstance(node, ast.Assign) else \
+            [node.target] if isinstance(node, (ast.AugAssign, ast.AnnAssign)) else []
+        for target in targets:
+            if isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name) \
+                    and target.value.id == env_name:
+                writes.add(target.attr)
+            elif isinstance(target, ast.Subscript) and isinstance(target.value, ast.Name) \
+                    and target.value.id == env_name:
+                key = target.slice
+                if not isinstance(key, ast.Constant) and hasattr(key, "value"):
+                    # Python < 3.9 wraps the subscript in an ast.Index
+                    key = key.value
+                if isinstance(key, ast.Constant) and isinstance(key.value, str):
+                    writes.add(key.value)
+    return writes
+
+
+def get_dependencies(runners, depends=None):
+    """
+    Get the names of the requests each request depends on.
+    A request depends on the earlier requests whose middleware sets an environment
+    variable it reads, plus any given explicitly in depends, a dict of name to names.
+    """
+    writers = []
+    dependencies = {}
+    for name, runner in runners:
+        reads = get_request_reads(runner.request)
+        dependencies[name] = set(w for w, writes in writers if writes & reads)
+        dependencies[name].update((depends or {}).get(name, ()))
+
+        folder_name = runner.folder.META.folder_name if runner.folder else None
+        middleware = get_named_middleware(folder_name, runner.request_name, middlewares=runner.middlewares)
+        writers.append((name, get_middleware_writes(middleware)))
+    return dependencies
+
+
+class RunReport(O):
+    """ The results of run_all """
+
+    def __repr__(self):
+        output = "{:<40} {:>8} {:>10} {:>10}\n".format("Request", "Status", "Start", "Time")
+        for result in self.results:
+            status = result.status if result.error is None else result.error
+            output += "{:<40} {:>8} {:>10} {:>10}\n".format(
+                result.name, str(status),
+                "{:.3f}s".format(result.start) if result.start is not None else "-",
+                "{:.3f}s".format(result.elapsed) if result.elapsed is not None else "-")
+        output += "\n{} requests: {} passed, {} failed, {} skipped in {:.3f}s ({:.3f}s of requests)".format(
+            len(self.results), self.passed, self.failed, self.skipped, self.elapsed, self.request_time)
+        return output
+
+
+def run_all(runners, concurrency=8, depends=None, env=None):
+    """
+    Run the (name, Runner) requests, concurrently where they don't depend on each other.
+    Requests whose dependencies failed are skipped.
+    Returns a RunReport with the status and timings of each request.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    dependencies = get_dependencies(runners, depends=depends)
+    results = OrderedDict((name, O(name=name, status=None, error=None, start=None, elapsed=None))
+                          for name, _ in runners)
+    runner_by_name = dict(runners)
+    pending = [name for name, _ in runners]
+    done, failed = set(), set()
+    start = time.perf_counter()
+    last = None
+
+    def run(name):
+        result = results[name]
+        result.start = time.perf_counter() - start
+        history_runner = runner_by_name[name].prepare(env=env)
+        try:
+            response = history_runner(update_globals=False)
+        finally:
+            result.elapsed = time.perf_counter() - start - result.start
+        H.add_history_item(history_runner)
+        result.status = getattr(response, "status_code", None)
+        return history_runner
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                if not dependencies[name] <= done:
+                    continue
+                pending.remove(name)
+                if dependencies[name] & failed:
+                    results[name].error = "skipped"
+                    failed.add(name)
+                    done.add(name)
+                else:
+                    running[executor.submit(run, name)] = name
+            if not running:
+                # What is left depends on requests that aren't being run, or on each other
+                for name in pending:
+                    results[name].error = "skipped"
+                    failed.add(name)
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                result = results[name]
+                try:
+                    last = future.result()
+                except Exception as e:
+                    result.error = type(e).__name__
+                if result.error is not None or (result.status is not None and result.status >= 400):
+                    failed.add(name)
+                done.add(name)
+
+    if last is not None:
+        last.set_globals()
+
+    results = list(results.values())
+    return RunReport(results=results,
+                     passed=len([r for r in results if r.name not in failed]),
+                     failed=len([r for r in results if r.name in failed and r.error != "skipped"]),
+                     skipped=len([r for r in results if r.error == "skipped"]),
+                     elapsed=time.perf_counter() - start,
+                     request_time=sum(r.elapsed for r in results if r.elapsed is not None))
+
+
+class LatencyHistogram(object):
+    """
+    Mergeable latency histogram.
+    Latencies are recorded in microseconds, bucketed to 3 significant digits,
+    so the percentiles are accurate to within 1%.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def get_bucket(micros):
+        """ Round the microseconds down to 3 significant digits """
+        if micros < 1000:
+            return micros
+        scale = 10 ** (len(str(micros)) - 3)
+        return micros // scale * scale
+
+    def record(self, seconds):
+        """ Record a latency, in seconds """
+        micros = max(int(seconds * 1000000), 0)
+        bucket = self.get_bucket(micros)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other):
+        """ Merge the other histogram into this one """
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def percentile(self, percent):
+        """ Get the latency, in seconds, at the given percentile """
+        if not self.count:
+            return None
+        rank = max(percent / 100.0 * self.count, 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return bucket / 1000000.0
+        return self.max
+
+    def mean(self):
+        """ Get the mean latency, in seconds """
+        return self.total / self.count if self.count else None
+
+
+def parse_rate(rate):
+    """ Parse a rate like 500/s, 30/m or 100 into requests per second """
+    count, _, unit = str(rate).partition("/")
+    per = {"": 1, "s": 1, "m": 60, "h": 3600}[unit.strip()]
+    return float(count) / per
+
+
+def parse_duration(duration):
+    """ Parse a duration like 60s, 500ms, 2m or 10 into seconds """
+    match = re.match(r'^\s*([0-9.]+)\s*(ms|s|m|h)?\s*$', str(duration))
+    if not match:
+        raise ValueError("Invalid duration: {}".format(duration))
+    return float(match.group(1)) * {None: 1, "ms": 0.001, "s": 1, "m": 60, "h": 3600}[match.group(2)]
+
+
+def run_benchmark(runner, rate, duration, concurrency=64, env=None):
+    """
+    Run the request at a fixed arrival rate for duration seconds.
+    The scheduler is open-loop: requests are started on schedule whether or not
+    earlier ones have finished, and latency is measured from the time the request
+    was scheduled to start, so a slow server can't hide its queueing delay
+    (coordinated omission).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    interval = 1.0 / rate
+    total = int(rate * duration)
+    local = threading.local()
+    all_stats = []
+    stats_lock = threading.Lock()
+
+    def get_stats():
+        if not hasattr(local, "stats"):
+            local.stats = O(histogram=LatencyHistogram(), errors=0, statuses={})
+            with stats_lock:
+                all_stats.append(local.stats)
+        return local.stats
+
+    def call(scheduled):
+        stats = get_stats()
+        try:
+            history_runner = runner.prepare(env=env)
+            response = history_runner(update_globals=False)
+            status = getattr(response, "status_code", None)
+            if status is not None and status >= 400:
+                stats.errors += 1
+        except Exception as e:
+            status = type(e).__name__
+            stats.errors += 1
+        stats.histogram.record(time.perf_counter() - scheduled)
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(total):
+            scheduled = start + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(call, scheduled)
+    elapsed = time.perf_counter() - start
+
+    histogram = LatencyHistogram()
+    errors = 0
+    statuses = {}
+    for stats in all_stats:
+        histogram.merge(stats.histogram)
+        errors += stats.errors
+        for status, count in stats.statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+
+    return O(requests=histogram.count,
+             errors=errors,
+             statuses=statuses,
+             elapsed=elapsed,
+             rate=rate,
+             throughput=histogram.count / elapsed if elapsed else 0.0,
+             histogram=histogram)
+
+
+def format_benchmark(report):
+    """ Format the benchmark report for printing """
+    def ms(seconds):
+        return "{:.2f}ms".format(seconds * 1000) if seconds is not None else "-"
+
+    histogram = report.histogram
+    output = "Requests: {} in {:.2f}s ({:.1f}/s, target {:.1f}/s)\n".format(
+        report.requests, report.elapsed, report.throughput, report.rate)
+    output += "Errors: {}\n".format(report.errors)
+    output += "Status Codes: {}\n".format(
+        ", ".join("{}={}".format(k, v) for k, v in sorted(report.statuses.items(), key=str)))
+    output += "Latency: min={} mean={} max={}\n".format(
+        ms(histogram.min), ms(histogram.mean()), ms(histogram.max))
+    for percent in (50, 90, 99, 99.9):
+        output += "  p{:<5} {}\n".format(percent, ms(histogram.percentile(percent)))
+    return output
+
+
+def iter_data_rows(path):
+    """
+    Lazily iterate the rows of the data file at path as dicts.  The file is a CSV file with a header row,
+    JSON lines if it ends in .jsonl or .ndjson, or else a JSON array of objects.
+    Only the current row is held in memory.
+    """
+    if path.endswith(".csv"):
+        import csv
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                yield row
+    elif path.endswith((".jsonl", ".ndjson")):
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line.decode("utf-8"))
+    else:
+        with open(path, "rb") as f:
+            stream = JsonStream(f)
+            for _ in stream.iter_array():
+                yield stream.value()
+
+
+def get_path(value, path):
+    """ Get the value at the dotted path, ex: items.0.id, or None if it isn't there """
+    for part in path.split("."):
+        if isinstance(value, (O, dict)):
+            value = value[part] if isinstance(value, O) else value.get(part)
+        elif isinstance(value, list) and part.lstrip("-").isdigit() and -len(value) <= int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return None
+    return value
+
+
+class ResultSink(object):
+    """
+    Writes the result of each iteration to the file at path as it comes in, as a line of JSON,
+    or as a CSV row if the path ends in .csv.  Nested values are written as JSON in CSV files.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.is_csv = path.endswith(".csv")
+        self.file = open(path, "w", newline="" if self.is_csv else None)
+        self.writer = None
+        self.count = 0
+
+    def write(self, result):
+        if not self.is_csv:
+            self.file.write(json.dumps(result, default=json_default) + "\n")
+        else:
+            if self.writer is None:
+                import csv
+                self.writer = csv.DictWriter(self.file, fieldnames=list(result))
+                self.writer.writeheader()
+            self.writer.writerow({k: json.dumps(v, default=json_default) if is_container(v) else v
+                                  for k, v in result.items()})
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return "ResultSink({!r}, {} results)".format(self.path, self.count)
+
+
+class IterationReport(O):
+    """ The results of run_iterations """
+
+    def __repr__(self):
+        def ms(seconds):
+            return "{:.2f}ms".format(seconds * 1000) if seconds is not None else "-"
+
+        output = "{} rows: {} passed, {} failed in {:.3f}s ({:.1f}/s)\n".format(
+            self.rows, self.passed, self.failed, self.elapsed, self.rows / self.elapsed if self.elapsed else 0.0)
+        output += "Status Codes: {}\n".format(
+            ", ".join("{}={}".format(k, v) for k, v in sorted(self.statuses.items(), key=str)))
+        output += "Latency: p50={} p99={} max={}".format(
+            ms(self.histogram.percentile(50)), ms(self.histogram.percentile(99)), ms(self.histogram.max))
+        return output
+
+
+def run_iterations(runner, rows, sink=None, fields=(), concurrency=8, env=None, middlewares=None, auth=None):
+    """
+    Run the Runner once for each row of rows, with the row layered over env, on a pool of concurrency threads.
+    Rows are only taken from rows while fewer than twice concurrency are in flight, so rows can be a
+    generator over a file of any size.  The calls aren't added to the history, instead the result of each
+    row (its index, status, error, timings in ms and the response fields at the dotted paths in fields)
+    is written to sink, a path or a ResultSink, if given.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    env = env or runner.env
+    close_sink = isinstance(sink, str)
+    if close_sink:
+        sink = ResultSink(sink)
+    histogram = LatencyHistogram()
+    statuses = {}
+    failed = 0
+
+    def run(index, row):
+        result = OrderedDict([("row", index), ("status", None), ("error", None)])
+        history_runner = None
+        try:
+            history_runner = runner.prepare(env=env._layer(**row), middlewares=middlewares, auth=auth)
+            response = history_runner(update_globals=False)
+            result["status"] = getattr(response, "status_code", None)
+        except Exception as e:
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        timings = history_runner.timings if history_runner is not None else O()
+        for phase in TIMING_PHASES:
+            result[phase + "_ms"] = round(timings[phase] * 1000, 3) if timings[phase] is not None else None
+        for field in fields:
+            result[field] = get_path(history_runner.json, field) if history_runner is not None else None
+        return result, timings.total
+
+    def finish(future):
+        nonlocal failed
+        result, total = future.result()
+        status = result["status"] if result["error"] is None else "error"
+        statuses[status] = statuses.get(status, 0) + 1
+        if result["error"] is not None or (result["status"] is not None and result["status"] >= 400):
+            failed += 1
+        if total is not None:
+            histogram.record(total)
+        if sink is not None:
+            sink.write(result)
+
+    start = time.perf_counter()
+    count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            running = set()
+            try:
+                for index, row in enumerate(rows):
+                    if len(running) >= concurrency * 2:
+                        finished, running = wait(running, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            finish(future)
+                    running.add(executor.submit(run, index, row))
+                    count += 1
+            finally:
+                # Record the rows already started, even if reading the next row failed
+                for future in wait(running)[0]:
+                    finish(future)
+    finally:
+        if close_sink:
+            sink.close()
+
+    return IterationReport(rows=count,
+                           passed=count - failed,
+                           failed=failed,
+                           statuses=statuses,
+                           elapsed=time.perf_counter() - start,
+                           histogram=histogram)
+
+
+def bench_main(argv):
+    """ Entry point for the bench command """
+    parser = argparse.ArgumentParser(prog='postman_repl bench',
+                                     description='Drive a request at a fixed rate and report latency')
+    add_load_args(parser)
+
+    parser.add_argument('request_name', metavar='Request',
+                    help='The request to run, as folder.request')
+
+    parser.add_argument('--rate', '-r', default='10/s',
+                    help='The arrival rate, ex: 500/s or 30/m')
+
+    parser.add_argument('--duration', '-d', default='10s',
+                    help='How long to run for, ex: 60s or 2m')
+
+    parser.add_argument('--concurrency', '-c', type=int, default=64,
+                    help='The maximum number of requests in flight')
+
+    args = parser.parse_args(argv)
+    # Don't log the requests while the benchmark runs, unless asked to
+    LOG.level = "silent"
+    LOG.stream = sys.stderr
+    load_args(args)
+    runner = get_request(P, args.request_name)
+
+    report = run_benchmark(runner, parse_rate(args.rate), parse_duration(args.duration),
+                           concurrency=args.concurrency)
+    SESSIONS.close()
+    print(format_benchmark(report))
+    return 1 if report.errors else 0
+
+
+def write_run_output(name, response, output, out=None):
+    """ Write the result of a headless run in the given output format: json, raw or status """
+    out = out or sys.stdout
+    status = getattr(response, "status_code", None)
+    if output == "status":
+        out.write("{} {}\n".format(status, name))
+    elif output == "raw":
+        out.flush()
+        content = getattr(response, "content", None)
+        if content is None:
+            content = b""
+        elif not isinstance(content, bytes):
+            content = str(content).encode("utf-8")
+        if hasattr(out, "buffer"):
+            out.buffer.write(content)
+        else:
+            out.write(content.decode("utf-8", "replace"))
+        out.flush()
+    else:
+        try:
+            body = response.json()
+        except Exception:
+            body = getattr(response, "text", None)
+        elapsed = getattr(response, "elapsed", None)
+        out.write(json.dumps({"request": name,
+                              "status": status,
+                              "elapsed": elapsed.total_seconds() if elapsed is not None else None,
+                              "body": body}, default=json_default) + "\n")
+
+
+def run_main(argv):
+    """ Entry point for the run command, running requests without the repl """
+    parser = argparse.ArgumentParser(prog='postman_repl run',
+                                     description='Run requests from a collection and exit')
+    add_load_args(parser)
+
+    parser.add_argument('request_names', nargs='*', metavar='Request',
+                    help='The requests to run, as folder.request. Read one per line from stdin if none are given, or -')
+
+    parser.add_argument('--set', '-s', dest='env_values', action='append', default=[], metavar='KEY=VALUE',
+                    help='Set an environment value, can be given more than once')
+
+    parser.add_argument('--output', '-o', choices=('json', 'raw', 'status'), default='status',
+                    help='What to print for each response')
+
+    args = parser.parse_intermixed_args(argv)
+    load_args(args)
+    for value in args.env_values:
+        key, sep, val = value.partition("=")
+        if not sep:
+            parser.error("--set must be given as KEY=VALUE: {}".format(value))
+        E[key] = val
+
+    names = args.request_names
+    if not names or names == ["-"]:
+        names = (line.strip() for line in sys.stdin)
+
+    failed = False
+    for name in names:
+        if not name or name.startswith("#"):
+            continue
+        try:
+            runner = get_request(P, name)
+            # Keep the request logging out of the output
+            with contextlib.redirect_stdout(sys.stderr):
+                response = runner()
+        except Exception as e:
+            sys.stderr.write("{}: {}: {}\n".format(name, type(e).__name__, e))
+            failed = True
+            continue
+        write_run_output(name, response, args.output)
+        status = getattr(response, "status_code", None)
+        if status is not None and status >= 400:
+            failed = True
+
+    SESSIONS.close()
+    return 1 if failed else 0
+
+
+def runall_main(argv):
+    """ Entry point for the runall command, running every request in the collection or folders """
+    parser = argparse.ArgumentParser(prog='postman_repl runall',
+                                     description='Run all the requests in a collection, concurrently where possible')
+    add_load_args(parser)
+
+    parser.add_argument('folder_names', nargs='*', metavar='Folder',
+                    help='Only run the requests in these folders')
+
+    parser.add_argument('--concurrency', '-c', type=int, default=8,
+                    help='The maximum number of requests to run at once')
+
+    parser.add_argument('--depends', '-d', action='append', default=[], metavar='REQUEST=REQUEST,...',
+                    help='Declare that a folder.request depends on other requests, can be given more than once')
+
+    args = parser.parse_intermixed_args(argv)
+    load_args(args)
+
+    depends = {}
+    for value in args.depends:
+        name, sep, names = value.partition("=")
+        if not sep:
+            parser.error("--depends must be given as REQUEST=REQUEST,...: {}".format(value))
+        depends.setdefault(name, set()).update(n for n in names.split(",") if n)
+
+    runners = []
+    for folder_name in args.folder_names or [None]:
+        folder = P if folder_name is None else P[fix_name(folder_name)]
+        if not isinstance(folder, Folder):
+            parser.error("No folder named {}".format(folder_name))
+        runners.extend(folder._runners("" if folder_name is None else fix_name(folder_name) + "."))
+
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_all(runners, concurrency=args.concurrency, depends=depends)
+    SESSIONS.close()
+    print(repr(report))
+    return 1 if report.failed or report.skipped else 0
+
+
+def iterate_main(argv):
+    """ Entry point for the iterate command, running a request once per row of a data file """
+    parser = argparse.ArgumentParser(prog='postman_repl iterate',
+                                     description='Run a request once for each row of a CSV, JSON or JSON lines file')
+    add_load_args(parser)
+
+    parser.add_argument('request_name', metavar='Request',
+                    help='The request to run, as folder.request')
+
+    parser.add_argument('--data', required=True, dest='data_path',
+                    help='The data file, rows are merged into the environment for each run')
+
+    parser.add_argument('--output', '-o', dest='output_path',
+                    help='Write the result of each row to this .jsonl or .csv file')
+
+    parser.add_argument('--field', '-f', dest='fields', action='append', default=[], metavar='PATH',
+                    help='A dotted path into the JSON response to add to the output, can be given more than once')
+
+    parser.add_argument('--concurrency', '-c', type=int, default=8,
+                    help='The maximum number of requests to run at once')
+
+    args = parser.parse_intermixed_args(argv)
+    load_args(args)
+
+    try:
+        runner = get_request(P, args.request_name)
+    except KeyError as e:
+        parser.error(e.args[0])
+
+    with contextlib.redirect_stdout(sys.stderr):
+        report = runner._iterate(args.data_path, sink=args.output_path, fields=args.fields,
+                                 concurrency=args.concurrency)
+    SESSIONS.close()
+    print(repr(report))
+    return 1 if report.failed else 0
+
+
+"""The commands that can be given as the first argument to postman_repl"""
+COMMANDS = {
+    "bench": bench_main,
+    "iterate": iterate_main,
+    "run": run_main,
+    "runall": runall_main,
+}
+
+
 def main():
     """ Main entry point for repl """
-    global E, P, MW
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
+    # Only the repl needs IPython, the commands above don't pay for importing it
+    import IPython
 
     args = parse_args()
-    if args.env_path:
-        E = load_environment(args.env_path)
-    P = load_collection(args.collection_path)
-    if args.middleware_path:
-        MW = load_middleware(args.middleware_path)
-    IPython.embed()
+    load_args(args)
+    if args.history_path:
+        H.store = HistoryStore(args.history_path)
+    # Run cells with top level await on an asyncio loop, for _async requests
+    IPython.embed(using="asyncio")
+    SESSIONS.close()
+    CASSETTE.stop()
+    if H.store is not None:
+        H.store.close()
 
 
 if __name__ == "__main__":
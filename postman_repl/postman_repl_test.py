@@ -3,6 +3,18 @@
 Tests for postman repl
 """
 
+import asyncio
+import contextlib
+import csv
+import gc
+import http.server
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import urllib
 import postman_repl as pmr
@@ -52,6 +64,30 @@ class TestO(unittest.TestCase):
         self.assertDictEqual(json.loads(test._to_json()),
                              {'x': 1, 'y': 2, 'z': {'x': 1, 'y': 2}})
 
+    def test_todict_recursive_copy(self):
+        leaf = {1, 2}
+        test = pmr.O(x=[pmr.O(y=leaf)], z=(1, 2))
+        copied = test._to_dict_recursive()
+        self.assertDictEqual(copied, {'x': [{'y': {1, 2}}], 'z': [1, 2]})
+        self.assertIsNot(copied['x'][0]['y'], leaf)
+        self.assertIs(test._to_dict_recursive(copy_leaves=False)['x'][0]['y'], leaf)
+
+    def test_deep(self):
+        test = pmr.O(x=1)
+        for _ in range(5000):
+            test = pmr.O(n=test)
+        self.assertEqual(len(pmr.to_plain(test)), 1)
+        self.assertTrue(test._to_json().startswith('{"n": {"n": '))
+
+    def test_encode_json(self):
+        test = pmr.O(x=1, y=[pmr.O(z="a"), (1, 2), None], w={'v': True})
+        self.assertEqual(pmr.encode_json(test), test._to_json())
+
+    def test_repr_truncated(self):
+        test = pmr.O(x=list(range(10)), y=pmr.O(z=pmr.O(w=1)))
+        self.assertDictEqual(pmr.to_plain(test, max_items=3, max_depth=2),
+                             {'x': [0, 1, 2, '... 7 more'], 'y': {'z': '{...}'}})
+
     def test_new_recursive(self):
         expect = pmr.O(x=1, y=2, z=pmr.O(x=1, y=2))
         test = {'x': 1, 'y': 2, 'z': {'x': 1, 'y': 2}}
@@ -72,6 +108,1110 @@ class TestO(unittest.TestCase):
         self.assertListEqual([x._to_dict_recursive() for x in test], expect)
 
 
+class TestLazyO(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {'x': 1, 'y': {'z': [{'a': 1}, [{'b': 2}], 3]}}
+
+    def test_access(self):
+        test = pmr.new_lazy(self.data)
+        self.assertIsInstance(test, pmr.O)
+        self.assertEqual(test.x, 1)
+        self.assertEqual(test["y"].z[0].a, 1)
+        self.assertEqual(test.y.z[1][0].b, 2)
+        self.assertEqual(test.y.z[2], 3)
+        self.assertIs(test.y, test.y)
+        self.assertEqual(test.missing, None)
+
+    def test_lazy(self):
+        test = pmr.new_lazy(self.data)
+        self.assertIsInstance(self.data['y'], dict)
+        test.y
+        self.assertIsInstance(self.data['y'], pmr.LazyO)
+        self.assertIsInstance(self.data['y'].__dict__['z'], list)
+
+    def test_list(self):
+        test = pmr.new_lazy([{'a': 1}, {'a': 2}])
+        self.assertListEqual([x.a for x in test], [1, 2])
+        self.assertEqual(test[-1].a, 2)
+        self.assertEqual(test[1:][0].a, 2)
+
+    def test_todict_recursive(self):
+        test = pmr.new_lazy(self.data)
+        test.y.z[0].a = 5
+        self.assertDictEqual(test._to_dict_recursive(),
+                             {'x': 1, 'y': {'z': [{'a': 5}, [{'b': 2}], 3]}})
+        self.assertDictEqual(json.loads(test._to_json()), test._to_dict_recursive())
+
+
+class TestChainO(unittest.TestCase):
+
+    def setUp(self):
+        self.globals = pmr.O(host="global.example.com", timeout=10)
+        self.env = pmr.ChainO(self.globals, host="env.example.com", nested=pmr.O(a=1))
+
+    def test_layers(self):
+        test = self.env._layer(user="me")
+        self.assertEqual(test.user, "me")
+        self.assertEqual(test.host, "env.example.com")
+        self.assertEqual(test.timeout, 10)
+        self.assertEqual(test.missing, None)
+        self.assertIs(test.nested, self.env.nested)
+        self.assertTrue("timeout" in test)
+        self.assertFalse("user" in self.env)
+        self.assertEqual(sorted(test), ["host", "nested", "timeout", "user"])
+
+    def test_copy_on_write(self):
+        test = self.env._layer()
+        test.host = "test.example.com"
+        del test.timeout
+        self.assertEqual(test.host, "test.example.com")
+        self.assertEqual(test.timeout, None)
+        self.assertFalse("timeout" in test)
+        self.assertEqual(self.env.host, "env.example.com")
+        self.assertEqual(self.globals.timeout, 10)
+
+        test.timeout = 5
+        self.assertEqual(test.timeout, 5)
+        self.assertDictEqual(test._to_dict_recursive(),
+                             {"host": "test.example.com", "timeout": 5, "nested": {"a": 1}})
+        self.assertDictEqual(json.loads(test._to_json()), test._to_dict_recursive())
+
+    def test_version(self):
+        test = self.env._layer()
+        version = test._version()
+        self.globals.timeout = 20
+        self.assertGreater(test._version(), version)
+        self.assertEqual(test.timeout, 20)
+
+    def test_env_replace(self):
+        test = self.env._layer(user="me")
+        self.assertEqual(pmr.env_replace("{{user}}@{{host}}:{{timeout}}", test), "me@env.example.com:10")
+        self.globals.timeout = 20
+        self.assertEqual(pmr.env_replace("{{user}}@{{host}}:{{timeout}}", test), "me@env.example.com:20")
+        del test.host
+        self.assertEqual(pmr.env_replace("{{user}}@{{host}}:{{timeout}}", test), "me@:20")
+        self.assertEqual(pmr.env_replace("{{ range(2) | list }}", test), "[0, 1]")
+
+    def test_layer_flattened(self):
+        test = self.env
+        del test.timeout
+        for i in range(5000):
+            test = test._layer(user="user{}".format(i))
+        self.assertEqual(test._parents(), (self.globals,))
+        self.assertEqual(test.timeout, None)
+        self.assertEqual(pmr.env_replace("{{user}}@{{host}}", test), "user4999@env.example.com")
+        version = test._version()
+        self.globals.host = "changed.example.com"
+        self.assertGreater(test._version(), version)
+        test.timeout = 5
+        self.assertEqual(pmr.env_replace("{{user}}:{{timeout}}", test), "user4999:5")
+
+    def test_layer_snapshot(self):
+        for size in (0, 500):
+            base = pmr.O(host="base.example.com", **{"key{}".format(i): i for i in range(size)})
+            first = pmr.ChainO(base)._layer(x=1, **{"own{}".format(i): i for i in range(size)})
+            second = first._layer(y=2)
+            first.x = 99
+            base.host = "changed.example.com"
+            self.assertEqual((second.x, second.y, second.host), (1, 2, "changed.example.com"))
+            self.assertEqual(second._parents(), (base,))
+
+    def test_add_env(self):
+        collection = pmr.load_collection("../examples/JIRA.json.postman_collection")
+        runner = collection.sprints.rapidview
+        runner.env = self.env
+        test = runner.add_env(user="me")
+        self.assertIsInstance(test.env, pmr.ChainO)
+        self.assertEqual(test.env.host, "env.example.com")
+        self.assertFalse("user" in self.env)
+        self.assertIs(test.plan, runner.plan)
+
+
+class FakeStreamResponse(object):
+
+    def __init__(self, body, encoding="utf-8"):
+        self.body = body
+        self.encoding = encoding
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def iter_lines(self):
+        return iter(self.body.splitlines())
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_json_items(self):
+        body = json.dumps([{"a": 1, "b": "xéy"}, 12345, [1, 2], "]"]).encode("utf-8")
+        for chunk_size in (1, 3, 1024):
+            items = pmr.iter_json_items(FakeStreamResponse(body), chunk_size=chunk_size)
+            items = list(items)
+            self.assertEqual(items[0].b, "xéy")
+            self.assertEqual(items[1:], [12345, [1, 2], "]"])
+
+    def test_json_items_invalid(self):
+        with self.assertRaises(ValueError):
+            list(pmr.iter_json_items(FakeStreamResponse(b'{"a": 1}')))
+        with self.assertRaises(ValueError):
+            list(pmr.iter_json_items(FakeStreamResponse(b'[1, 2')))
+        for bad in (b'[1,,2]', b'[,1]', b'[1,]', b'[1 2]'):
+            with self.assertRaises(ValueError):
+                list(pmr.iter_json_items(FakeStreamResponse(bad)))
+
+    def test_json_items_large(self):
+        # A 4MB item read in small chunks is scanned once, rather than parsed again for every chunk
+        body = json.dumps([{"a": "x" * (4 * 1024 * 1024)}, 1]).encode("utf-8")
+        start = time.perf_counter()
+        items = list(pmr.iter_json_items(FakeStreamResponse(body), chunk_size=1000))
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertEqual(len(items[0].a), 4 * 1024 * 1024)
+        self.assertEqual(items[1], 1)
+
+    def test_ndjson(self):
+        body = b'{"a": 1}\n\n{"a": 2}\n'
+        self.assertListEqual([x.a for x in pmr.iter_ndjson(FakeStreamResponse(body))], [1, 2])
+
+    def test_save_stream(self):
+        path = os.path.join(tempfile.mkdtemp(), "body")
+        pmr.save_stream(FakeStreamResponse(b"abcdef"), path, chunk_size=4)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"abcdef")
+
+
+class TestTemplateCache(unittest.TestCase):
+
+    def setUp(self):
+        pmr.TEMPLATE_CACHE.clear()
+
+    def test_version(self):
+        test = pmr.O(x=1)
+        self.assertEqual(test._version(), 0)
+        test.y = 2
+        del test.x
+        self.assertEqual(test._version(), 2)
+        self.assertDictEqual(test._to_dict(), {'y': 2})
+
+    def test_cache_hits(self):
+        env = pmr.O(host="localhost")
+        self.assertEqual(pmr.env_replace("{{host}}", env), "localhost")
+        self.assertEqual(pmr.env_replace("{{host}}", env), "localhost")
+        self.assertEqual(pmr.TEMPLATE_CACHE.hits, 1)
+        self.assertEqual(pmr.TEMPLATE_CACHE.misses, 1)
+
+    def test_env_change(self):
+        env = pmr.O(host="localhost")
+        self.assertEqual(pmr.env_replace("{{host}}", env), "localhost")
+        env.host = "example.com"
+        self.assertEqual(pmr.env_replace("{{host}}", env), "example.com")
+
+    def test_no_template_syntax(self):
+        from jinja2 import Template
+        env = pmr.O()
+        for data in ("a", "a\n", "a\n\n", "a\r\nb\r\n", "a\rb", "\n", ""):
+            self.assertEqual(pmr.env_replace(data, env), Template(data).render())
+        self.assertEqual(pmr.TEMPLATE_CACHE.misses, 0)
+
+    def test_lazy_imports(self):
+        code = ("import sys, postman_repl; "
+                "print(','.join(m for m in ('IPython', 'jinja2', 'requests') if m in sys.modules))")
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), b"")
+
+    def test_maxsize(self):
+        cache = pmr.TemplateCache(maxsize=2)
+        for source in ("a", "b", "c"):
+            cache.get_template(source)
+        self.assertEqual(list(cache.templates), ["b", "c"])
+
+
+class TestSessionManager(unittest.TestCase):
+
+    def test_session_per_host(self):
+        sessions = pmr.SessionManager()
+        first = sessions.get_session("https://example.com/a")
+        self.assertIs(first, sessions.get_session("https://example.com/b?c=d"))
+        self.assertIsNot(first, sessions.get_session("http://example.com/a"))
+        sessions.close()
+        self.assertEqual(sessions.sessions, {})
+
+    def test_session_per_env(self):
+        sessions = pmr.SessionManager(scope="env")
+        env1, env2 = pmr.O(), pmr.O()
+        first = sessions.get_session("https://example.com", env=env1)
+        self.assertIs(first, sessions.get_session("https://other.com", env=env1))
+        self.assertIsNot(first, sessions.get_session("https://example.com", env=env2))
+
+    def test_session_per_env_collected(self):
+        sessions = pmr.SessionManager(scope="env")
+        closed = []
+        env = pmr.O()
+        session = sessions.get_session("https://example.com", env=env)
+        # Closing the session closes its adapters
+        session.get_adapter("https://example.com").close = lambda: closed.append(True)
+        del env, session
+        gc.collect()
+        self.assertEqual(len(sessions.sessions), 0)
+        self.assertTrue(closed)
+
+    def test_max_idle(self):
+        sessions = pmr.SessionManager(max_idle=0)
+        first = sessions.get_session("https://example.com")
+        time.sleep(0.01)
+        self.assertIsNot(first, sessions.get_session("https://example.com"))
+
+
+def make_response(status_code=200, headers=None, content=b"body"):
+    from requests.models import Response
+    from requests.structures import CaseInsensitiveDict
+    response = Response()
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers or {})
+    response._content = content
+    response.url = "https://example.com"
+    return response
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_fresh_hit(self):
+        cache = pmr.ResponseCache(enabled=True)
+        sent = []
+        send = lambda kw: sent.append(kw) or make_response(headers={"Cache-Control": "max-age=60"})
+        response, status = cache.fetch("GET", "https://example.com", {}, send)
+        self.assertEqual(status, "miss")
+        response, status = cache.fetch("GET", "https://example.com", {}, send)
+        self.assertEqual(status, "hit")
+        self.assertEqual(response.content, b"body")
+        self.assertEqual(len(sent), 1)
+        _, status = cache.fetch("GET", "https://example.com", {"params": {"a": "1"}}, send)
+        self.assertEqual(status, "miss")
+
+    def test_revalidate(self):
+        cache = pmr.ResponseCache(enabled=True)
+        sent = []
+
+        def send(kw):
+            sent.append(kw)
+            if kw.get("headers", {}).get("If-None-Match") == '"v1"':
+                return make_response(304, headers={"ETag": '"v1"'}, content=b"")
+            return make_response(headers={"ETag": '"v1"', "Cache-Control": "no-cache"})
+
+        cache.fetch("GET", "https://example.com", {}, send)
+        response, status = cache.fetch("GET", "https://example.com", {}, send)
+        self.assertEqual(status, "revalidated")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"body")
+        self.assertEqual(len(sent), 2)
+
+    def test_revalidate_lowercase_headers(self):
+        cache = pmr.ResponseCache(enabled=True)
+        sent = []
+
+        def send(kw):
+            sent.append(kw)
+            if kw.get("headers"):
+                return make_response(304, headers={"ETag": '"v1"', "Cache-Control": "no-cache"}, content=b"")
+            return make_response(headers={"etag": '"v1"', "last-modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+                                          "cache-control": "no-cache"})
+
+        cache.fetch("GET", "https://example.com", {}, send)
+        response, status = cache.fetch("GET", "https://example.com", {}, send)
+        self.assertEqual(status, "revalidated")
+        self.assertDictEqual(sent[1]["headers"], {"If-None-Match": '"v1"',
+                                                  "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"})
+        entry = cache.get(cache.get_key("GET", "https://example.com", {}))
+        self.assertEqual(sorted(name.lower() for name in entry["headers"]),
+                         sorted(set(name.lower() for name in entry["headers"])))
+        self.assertEqual(response.headers["ETag"], '"v1"')
+
+    def test_not_cached(self):
+        cache = pmr.ResponseCache(enabled=True)
+        send = lambda kw: make_response(headers={"Cache-Control": "no-store, max-age=60"})
+        self.assertEqual(cache.fetch("POST", "https://example.com", {}, send)[1], None)
+        cache.fetch("GET", "https://example.com", {}, send)
+        self.assertEqual(cache.fetch("GET", "https://example.com", {}, send)[1], "miss")
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = pmr.ResponseCache(enabled=True, max_bytes=4, cache_dir=cache_dir)
+            send = lambda kw: make_response(headers={"Cache-Control": "max-age=60"})
+            cache.fetch("GET", "https://example.com/a", {}, send)
+            cache.fetch("GET", "https://example.com/b", {}, send)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            response, status = cache.fetch("GET", "https://example.com/a", {}, send)
+            self.assertEqual(status, "hit")
+            self.assertEqual(response.content, b"body")
+
+    def test_vary_custom_auth(self):
+        import requests.auth
+        vary = pmr.ResponseCache.get_vary
+        self.assertEqual(vary(requests.auth.HTTPBasicAuth("user", "pass")),
+                         vary(requests.auth.HTTPBasicAuth("user", "pass")))
+        self.assertNotEqual(vary(requests.auth.HTTPBasicAuth("user", "pass")),
+                            vary(requests.auth.HTTPBasicAuth("user", "other")))
+        self.assertNotEqual(vary(requests.auth.HTTPBasicAuth("user", "pass")),
+                            vary(requests.auth.HTTPProxyAuth("user", "pass")))
+        self.assertIs(vary(requests.auth.HTTPDigestAuth("user", "pass")), False)
+        self.assertIs(vary(None), None)
+
+
+class TestCassette(unittest.TestCase):
+
+    def test_record_replay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cassette.jsonl")
+            cassette = pmr.Cassette()
+            cassette.record(path)
+            responses = iter([make_response(content=b'{"a": 1}'), make_response(content=b"\xff")])
+            send = lambda kw: next(responses)
+            cassette.fetch("GET", "https://example.com", {"params": {"a": 1}}, send)
+            cassette.fetch("POST", "https://example.com", {"json": {"b": 2}}, send)
+            cassette.stop()
+
+            cassette.replay(path)
+            fail = lambda kw: self.fail("Replay sent a request")
+            response = cassette.fetch("GET", "https://example.com", {"params": {"a": "1"}}, fail)
+            self.assertEqual(response.json(), {"a": 1})
+            response = cassette.fetch("POST", "https://example.com", {"json": {"b": 2}}, fail)
+            self.assertEqual(response.content, b"\xff")
+            with self.assertRaises(KeyError):
+                cassette.fetch("POST", "https://example.com", {"json": {"b": 3}}, fail)
+
+            cassette.match_on = ("method", "url")
+            cassette.replay(path)
+            response = cassette.fetch("POST", "https://example.com", {"json": {"b": 3}}, fail)
+            self.assertEqual(response.status_code, 200)
+            cassette.stop()
+
+
+class TestInstruments(unittest.TestCase):
+
+    def run_item(self, instruments, status=200):
+        item = pmr.HistoryRunner({"method": "GET"}, {}, pmr.O(), lambda run, kwargs, env: run(kwargs), None,
+                                 "http://localhost", request_name="request", folder_name="folder")
+        item.send = lambda kwargs, session: make_response(status, content=b'{"a": 1}')
+        old, pmr.INSTRUMENTS = pmr.INSTRUMENTS, instruments
+        try:
+            item(update_globals=False)
+        finally:
+            pmr.INSTRUMENTS = old
+        instruments.flush()
+        return item
+
+    def test_events(self):
+        events = []
+        instruments = pmr.Instruments()
+        instruments.add(events.append)
+        self.run_item(instruments)
+        self.assertListEqual([(e.event, e.kind) for e in events],
+                             [("start", "request"), ("start", "http"), ("end", "http"), ("end", "request")])
+        request, http = events[3], events[2]
+        self.assertEqual(http.parent_span_id, request.span_id)
+        self.assertEqual(http.trace_id, request.trace_id)
+        self.assertEqual(request.name, "folder.request")
+        self.assertEqual(request.status, 200)
+        self.assertEqual(request.bytes, 8)
+        self.assertEqual(request.duration, request.timings["total"])
+        instruments.close()
+
+    def test_exporters(self):
+        import socket
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        with tempfile.TemporaryDirectory() as tmp:
+            instruments = pmr.Instruments()
+            instruments.add(pmr.PrometheusExporter(os.path.join(tmp, "metrics.prom")))
+            instruments.add(pmr.SpanExporter(os.path.join(tmp, "spans.jsonl")))
+            instruments.add(pmr.StatsdExporter(*receiver.getsockname()))
+            self.run_item(instruments)
+            self.run_item(instruments, status=404)
+            instruments.close()
+
+            with open(os.path.join(tmp, "metrics.prom")) as f:
+                metrics = f.read()
+            self.assertTrue('postman_repl_requests_total{folder="folder",request="request",method="GET",status="404"} 1'
+                            in metrics)
+            self.assertTrue('postman_repl_request_duration_seconds_count{folder="folder",request="request",method="GET"} 2'
+                            in metrics)
+            with open(os.path.join(tmp, "spans.jsonl")) as f:
+                spans = [json.loads(line) for line in f]
+            self.assertEqual(len(spans), 4)
+            self.assertEqual(spans[1]["name"], "request folder.request")
+            self.assertEqual(spans[1]["attributes"]["http.status_code"], 200)
+        self.assertTrue(b"postman_repl.folder.request.requests:1|c" in receiver.recv(1000))
+        receiver.close()
+
+
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = pmr.load_collection("../examples/JIRA.json.postman_collection")
+        self.env = pmr.load_environment("../examples/test.env")
+        self.sent = []
+
+        async def send(runner, kwargs, client):
+            self.sent.append(kwargs)
+            await asyncio.sleep(0.05)
+            return make_response(content=b'{"token": "abc"}')
+
+        self.send = pmr.AsyncHistoryRunner.send
+        pmr.AsyncHistoryRunner.send = send
+
+    def tearDown(self):
+        pmr.AsyncHistoryRunner.send = self.send
+        pmr.H.history = []
+        pmr.R = None
+        pmr.J = None
+        pmr.D = None
+
+    def test_async(self):
+        runner = self.collection["sprints"]["rapidview"]
+
+        async def run():
+            return await asyncio.gather(*[runner._async(env=self.env, params={"page": i}) for i in range(20)])
+
+        start = time.perf_counter()
+        responses = asyncio.run(run())
+        # Run one after another they would take a second
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual([r.status_code for r in responses], [200] * 20)
+        self.assertEqual(sorted(kwargs["params"]["page"] for kwargs in self.sent), list(range(20)))
+        self.assertEqual(len(pmr.H.history), 20)
+        self.assertEqual(pmr.J.token, "abc")
+        self.assertTrue(pmr.H.history[0].timings.total > 0)
+
+    def test_async_middleware(self):
+        runner = self.collection["sprints"]["rapidview"]
+
+        async def async_middleware(run, kwargs, env):
+            result = await run(kwargs)
+            env.async_token = result.json()["token"]
+            return result
+
+        def middleware(run, kwargs, env):
+            result = run(kwargs)
+            env.token = result.json()["token"]
+            return result
+
+        asyncio.run(runner._async(env=self.env, middlewares=pmr.O(sprints_rapidview=async_middleware)))
+        asyncio.run(runner._async(env=self.env, middlewares=pmr.O(sprints_rapidview=middleware)))
+        self.assertEqual(self.env.async_token, "abc")
+        self.assertEqual(self.env.token, "abc")
+        self.assertEqual(asyncio.run(pmr.H(0)).status_code, 200)
+
+    def test_cache_warning(self):
+        runner = self.collection["sprints"]["rapidview"]
+        pmr.CACHE.enabled = True
+        try:
+            with self.assertWarns(UserWarning):
+                asyncio.run(runner._async(env=self.env))
+        finally:
+            pmr.CACHE.enabled = False
+        self.assertEqual(len(self.sent), 1)
+
+    def test_httpx_kwargs(self):
+        kwargs = pmr.get_httpx_kwargs({"data": "body", "params": {"a": "b"}, "allow_redirects": False})
+        self.assertDictEqual(kwargs, {"content": "body", "params": {"a": "b"}, "follow_redirects": False})
+        self.assertDictEqual(pmr.get_httpx_kwargs({"data": {"a": "b"}}), {"data": {"a": "b"}, "follow_redirects": True})
+        with self.assertRaises(ValueError):
+            pmr.get_httpx_kwargs({"stream": True})
+        kwargs = pmr.get_httpx_kwargs({"stream": False, "verify": False, "cert": None, "proxies": {}})
+        self.assertDictEqual(kwargs, {"follow_redirects": True})
+
+    def test_async_client_options(self):
+        import ssl
+        sessions = pmr.SessionManager()
+
+        async def get_clients():
+            try:
+                return (sessions.get_async_client(), sessions.get_async_client(verify=False),
+                        sessions.get_async_client(verify=False),
+                        sessions.get_async_client(proxies={"http": "http://localhost:3128"}))
+            finally:
+                await sessions.aclose()
+
+        default, unverified, unverified_again, proxied = asyncio.run(get_clients())
+        self.assertIs(unverified, unverified_again)
+        self.assertEqual(len({id(default), id(unverified), id(proxied)}), 3)
+        self.assertEqual(pmr.get_ssl_context(False).verify_mode, ssl.CERT_NONE)
+        self.assertEqual(pmr.get_ssl_context(None).verify_mode, ssl.CERT_REQUIRED)
+
+
+class TestRequestLog(unittest.TestCase):
+
+    def log(self, level, kwargs, auth=None, **settings):
+        out = io.StringIO()
+        pmr.RequestLog(level=level, stream=out, **settings).log("POST", "http://localhost", kwargs, auth)
+        return out.getvalue()
+
+    def test_levels(self):
+        kwargs = {"params": {"a": "b"}, "headers": {"Accept": "text/plain"}, "data": "body"}
+        self.assertEqual(self.log("silent", kwargs), "")
+        self.assertEqual(self.log("summary", kwargs), "[POST] http://localhost\n")
+        full = self.log("full", kwargs)
+        self.assertTrue('Params:  {"a": "b"}' in full)
+        self.assertTrue('Headers:  {"Accept": "text/plain"}' in full)
+        self.assertTrue(full.endswith("Data: \n body\n"))
+        with self.assertRaises(ValueError):
+            self.log("loud", kwargs)
+
+    def test_truncate(self):
+        self.assertTrue(self.log("full", {"data": "x" * 100}, max_body=10).endswith("xxxxxxxxxx... (90 more)\n"))
+        self.assertTrue(self.log("full", {"data": b"y" * 100}, max_body=10).endswith("yyyyyyyyyy... (90 more)\n"))
+        self.assertTrue(self.log("full", {"json": {"a": 1}}).endswith('Data: \n {"a": 1}\n'))
+
+    def test_redact(self):
+        kwargs = {"params": {"api_key": "k", "q": "v"}, "headers": {"Authorization": "Basic abc", "X-Auth-Token": "t"}}
+        auth = pmr.O(type="basicAuth", username="user", password="pass")
+        full = self.log("full", kwargs, auth=auth)
+        self.assertTrue('"api_key": "***", "q": "v"' in full)
+        self.assertTrue('"Authorization": "***", "X-Auth-Token": "***"' in full)
+        self.assertTrue("'username': 'user'" in full and "'password': '***'" in full)
+        self.assertFalse("pass'" in full or "Basic abc" in full)
+
+    def test_send_request_auth(self):
+        class Session(object):
+            def request(self, method, url, **kwargs):
+                self.kwargs = kwargs
+
+        session = Session()
+        custom = object()
+        old, pmr.LOG.level = pmr.LOG.level, "silent"
+        try:
+            pmr.send_request({"method": "GET"}, "http://localhost", custom, session=session)
+            self.assertIs(session.kwargs["auth"], custom)
+            pmr.send_request({"method": "GET"}, "http://localhost",
+                             pmr.O(type="basicAuth", username="a", password="b"), session=session)
+            self.assertEqual(session.kwargs["auth"].username, "a")
+        finally:
+            pmr.LOG.level = old
+
+
+class TestAuthHandlers(unittest.TestCase):
+
+    def setUp(self):
+        pmr.AUTH_HANDLERS.clear()
+
+    def test_reuse(self):
+        request = {"id": "1", "method": "GET"}
+        basic = pmr.O(type="basicAuth", username="a", password="b")
+        handler = pmr.get_requests_auth(basic, request, "http://localhost/")
+        self.assertIs(pmr.get_requests_auth(pmr.O(type="basicAuth", username="a", password="b"),
+                                            request, "http://localhost/other"), handler)
+        self.assertIsNot(pmr.get_requests_auth(pmr.O(type="basicAuth", username="a", password="c"),
+                                               request, "http://localhost/"), handler)
+        self.assertIsNot(pmr.get_requests_auth(basic, {"id": "2"}, "http://localhost/"), handler)
+        self.assertIsNot(pmr.get_requests_auth(basic), handler)
+
+    def test_max_size(self):
+        pmr.AUTH_HANDLERS.maxsize = 2
+        try:
+            for i in range(3):
+                pmr.get_requests_auth(pmr.O(type="basicAuth", username=str(i), password="b"), {"id": "1"})
+            self.assertEqual(len(pmr.AUTH_HANDLERS.handlers), 2)
+        finally:
+            pmr.AUTH_HANDLERS.maxsize = 256
+
+    def test_digest_preemptive(self):
+        statuses = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get("Authorization", "").startswith("Digest "):
+                    statuses.append(200)
+                    self.send_response(200)
+                else:
+                    statuses.append(401)
+                    self.send_response(401)
+                    self.send_header("WWW-Authenticate", 'Digest realm="test", nonce="abc", qop="auth"')
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/".format(server.server_address[1])
+        old, pmr.LOG.level = pmr.LOG.level, "silent"
+        try:
+            for _ in range(3):
+                response = pmr.send_request({"id": "1", "method": "GET"}, url,
+                                            pmr.O(type="digestAuth", username="a", password="b"))
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(statuses, [401, 200, 200, 200])
+        finally:
+            pmr.LOG.level = old
+            server.shutdown()
+            server.server_close()
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = pmr.LatencyHistogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.5, places=2)
+        self.assertAlmostEqual(histogram.percentile(99), 0.99, places=2)
+        self.assertAlmostEqual(histogram.mean(), 0.5005)
+
+    def test_histogram_merge(self):
+        first, second = pmr.LatencyHistogram(), pmr.LatencyHistogram()
+        first.record(0.001)
+        second.record(0.003)
+        first.merge(second)
+        self.assertEqual(first.count, 2)
+        self.assertEqual(first.min, 0.001)
+        self.assertEqual(first.max, 0.003)
+        self.assertEqual(first.percentile(100), 0.003)
+
+    def test_parse(self):
+        self.assertEqual(pmr.parse_rate("500/s"), 500)
+        self.assertEqual(pmr.parse_rate("30/m"), 0.5)
+        self.assertEqual(pmr.parse_rate("20"), 20)
+        self.assertEqual(pmr.parse_duration("60s"), 60)
+        self.assertEqual(pmr.parse_duration("500ms"), 0.5)
+        self.assertEqual(pmr.parse_duration("2m"), 120)
+
+    def test_run_benchmark(self):
+        collection = pmr.load_collection("../examples/JIRA.json.postman_collection")
+        def middleware(run, kwargs, env):
+            return pmr.O(status_code=200)
+
+        runner = collection.sprints.rapidview.add_env()
+        runner.middlewares = pmr.O(sprints_rapidview=middleware)
+        report = pmr.run_benchmark(runner, 200, 0.1)
+        self.assertEqual(report.requests, 20)
+        self.assertEqual(report.errors, 0)
+        self.assertDictEqual(report.statuses, {200: 20})
+        self.assertEqual(pmr.H.history, [])
+
+
+class TestHistory(unittest.TestCase):
+
+    def make_item(self, data):
+        request = {"method": "GET"}
+        return pmr.HistoryRunner(request, {}, pmr.O(), None, None, "http://localhost", data=data)
+
+    def test_max_entries(self):
+        history = pmr.History(max_entries=2)
+        items = [self.make_item(b"x") for _ in range(3)]
+        for item in items:
+            history.add_history_item(item)
+        self.assertListEqual(history.history, items[1:])
+        self.assertEqual(history.body_bytes, 2)
+
+    def test_max_entries_releases_bodies(self):
+        for max_body_bytes in (None, 1000):
+            history = pmr.History(max_entries=2, max_body_bytes=max_body_bytes)
+            for _ in range(100):
+                history.add_history_item(self.make_item(b"x"))
+            self.assertEqual(len(history.history), 2)
+            self.assertEqual(len(history.loaded), 2)
+            self.assertListEqual(list(history.loaded), history.history)
+
+    def test_max_body_bytes(self):
+        history = pmr.History(max_body_bytes=10)
+        items = [self.make_item(b"12345") for _ in range(3)]
+        for item in items:
+            history.add_history_item(item)
+        self.assertEqual(len(history.history), 3)
+        self.assertEqual(history.body_bytes, 10)
+        self.assertIsNone(items[0].data)
+        self.assertEqual(items[2].data, b"12345")
+
+    def test_evict_keeps_response(self):
+        history = pmr.History(max_body_bytes=100)
+        responses = [make_response(content=b'{"a": "' + b"x" * 200 + b'"}') for _ in range(2)]
+        items = [pmr.HistoryRunner({"method": "GET"}, {}, pmr.O(), None, None, "http://localhost",
+                                   results=response, data=response.content) for response in responses]
+        for item in items:
+            history.add_history_item(item)
+        self.assertIsNotNone(items[1]._data)
+        self.assertIsNone(items[0]._data)
+        self.assertIsNone(items[0].results)
+        self.assertEqual([response.json()["a"] for response in responses], ["x" * 200] * 2)
+        self.assertListEqual(list(history.loaded), [items[1]])
+
+    def test_spill(self):
+        history = pmr.History(max_body_bytes=10, spill_dir=tempfile.mkdtemp())
+        items = [self.make_item(b'{"a": 1}') for _ in range(2)]
+        for item in items:
+            history.add_history_item(item)
+        self.assertIsNone(items[0]._data)
+        self.assertEqual(items[0].data, b'{"a": 1}')
+        self.assertEqual(items[0].json.a, 1)
+        self.assertTrue(os.path.exists(items[0].spill_path))
+
+    def test_lazy_doc(self):
+        item = self.make_item(b"x")
+        self.assertTrue(item.__doc__.startswith("[GET] http://localhost"))
+        self.assertTrue(pmr.HistoryRunner.__doc__.strip().startswith("Holds the state"))
+
+    def test_timings(self):
+        def middleware(run, kwargs, env):
+            time.sleep(0.01)
+            return run(kwargs)
+
+        history = pmr.History()
+        for _ in range(3):
+            item = pmr.HistoryRunner({"method": "GET"}, {}, pmr.O(), middleware, None, "http://localhost",
+                                     request_name="request", folder_name="folder")
+            item.send = lambda kwargs, session: make_response(content=b'{"a": 1}')
+            item(update_globals=False)
+            history.add_history_item(item)
+
+        self.assertTrue(set(pmr.TIMING_PHASES) <= set(item.timings._to_dict()))
+        self.assertGreaterEqual(item.timings.middleware, 0.01)
+        self.assertGreaterEqual(item.timings.total, item.timings.middleware + item.timings.parse)
+        self.assertTrue("Timings: total=" in item._get_info())
+
+        stats = history._stats()
+        self.assertEqual(stats["folder.request"].total.count, 3)
+        self.assertGreaterEqual(stats["folder.request"].middleware.p50, 0.01)
+        self.assertTrue("folder.request" in repr(stats))
+        self.assertEqual(history._stats(name="other")._to_dict(), {})
+
+
+class TestHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = pmr.HistoryStore(os.path.join(tempfile.mkdtemp(), "history.db"))
+
+    def tearDown(self):
+        self.store.close()
+
+    def make_item(self, method, url, status_code, request_name):
+        request = {"method": method, "url": url}
+        item = pmr.HistoryRunner(request, {"params": {"a": "1"}}, pmr.O(host="localhost"), None,
+                                 pmr.O(type="basicAuth", username="user", password="pass"), url,
+                                 data=b'{"x": 1}', request_name=request_name, folder_name="users")
+        item.status_code = status_code
+        item.timestamp = time.time()
+        return item
+
+    def test_query(self):
+        self.store.add(self.make_item("GET", "http://localhost/users/1", 200, "get_user"))
+        self.store.add(self.make_item("POST", "http://localhost/users", 201, "create_user"))
+        self.store.add(self.make_item("GET", "http://localhost/groups/1", 404, "get_group"))
+
+        self.assertEqual(len(self.store.query()), 3)
+        self.assertListEqual([x.url for x in self.store.query(method="get")],
+                             ["http://localhost/groups/1", "http://localhost/users/1"])
+        self.assertListEqual([x.request_name for x in self.store.query(url="*/users*")],
+                             ["create_user", "get_user"])
+        self.assertEqual(self.store.query(status=404)[0].request_name, "get_group")
+        self.assertEqual(len(self.store.query(folder="users", request="create_user")), 1)
+        self.assertEqual(len(self.store.query(since=time.time() + 60)), 0)
+        self.assertEqual(len(self.store.query(limit=1)), 1)
+
+    def test_load(self):
+        self.store.add(self.make_item("GET", "http://localhost/users/1", 200, "get_user"))
+        item = self.store.query()[0]
+        self.assertIsNone(item._data)
+        self.assertEqual(item.data, b'{"x": 1}')
+        self.assertEqual(item.json.x, 1)
+        self.assertEqual(item.env.host, "localhost")
+        self.assertEqual(item.auth.password, "pass")
+        self.assertDictEqual(item.kwargs, {"params": {"a": "1"}})
+
+    def test_env_snapshot(self):
+        item = self.make_item("GET", "http://localhost/users/1", 200, "get_user")
+        item.env.nested = pmr.O(a=1)
+        self.store.add(item)
+        item.env.host = "changed"
+        item = self.store.query()[0]
+        self.assertEqual(item.env.host, "localhost")
+        self.assertEqual(item.env.nested.a, 1)
+
+    def test_write_at_exit(self):
+        path = os.path.join(tempfile.mkdtemp(), "history.db")
+        script = ("import postman_repl as pmr\n"
+                  "pmr.H.store = pmr.HistoryStore({!r})\n"
+                  "for i in range(100):\n"
+                  "    item = pmr.HistoryRunner({{'method': 'GET'}}, {{}}, pmr.O(i=i), None, None, 'http://localhost')\n"
+                  "    pmr.H.add_history_item(item)\n").format(path)
+        subprocess.run([sys.executable, "-c", script], check=True)
+        store = pmr.HistoryStore(path)
+        try:
+            self.assertEqual(len(store.query(limit=1000)), 100)
+        finally:
+            store.close()
+
+    def test_replay(self):
+        called = [None]
+        def middleware(run, kwargs, env):
+            called[0] = (kwargs, env.host)
+
+        pmr.MW = pmr.O(users_get_user=middleware)
+        try:
+            self.store.add(self.make_item("GET", "http://localhost/users/1", 200, "get_user"))
+            self.store.query()[0]()
+        finally:
+            pmr.MW = pmr.O()
+        self.assertEqual(called[0], ({"params": {"a": "1"}}, "localhost"))
+
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self.mw_file = os.path.join(tempfile.mkdtemp(), "middleware.py")
+        with open(self.mw_file, "w") as f:
+            f.write("""
+class Response(object):
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = body.encode("utf-8")
+        self.text = body
+        self.elapsed = None
+    def json(self):
+        import json
+        return json.loads(self.text)
+
+def sprints_rapidview(run, kwargs, env):
+    return Response(200, '{"host": "%s"}' % env.host)
+
+def users_search_username(run, kwargs, env):
+    return Response(404, 'missing')
+""")
+
+    def tearDown(self):
+        pmr.H.history = []
+        pmr.MW = pmr.O()
+        pmr.E = pmr.O()
+        pmr.P = None
+
+    def test_command_skips_ipython(self):
+        script = ("import sys, postman_repl as pmr\n"
+                  "sys.argv = ['postman_repl'] + sys.argv[1:]\n"
+                  "try:\n"
+                  "    pmr.main()\n"
+                  "except SystemExit:\n"
+                  "    pass\n"
+                  "sys.__stdout__.write('IPython imported: {}'.format('IPython' in sys.modules))\n")
+        output = subprocess.run([sys.executable, "-c", script, "run", "../examples/JIRA.json.postman_collection",
+                                 "-e", "../examples/test.env", "-m", self.mw_file, "sprints.rapidview"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+        self.assertTrue(output.endswith("IPython imported: False"), output)
+
+    def run_main(self, *args):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+            code = pmr.run_main(["../examples/JIRA.json.postman_collection", "-e", "../examples/test.env",
+                                 "-m", self.mw_file] + list(args))
+        return code, out.getvalue()
+
+    def test_run_status(self):
+        code, output = self.run_main("sprints.rapidview")
+        self.assertEqual(code, 0)
+        self.assertEqual(output, "200 sprints.rapidview\n")
+
+    def test_run_json(self):
+        code, output = self.run_main("sprints.rapidview", "--set", "host=example.com", "-o", "json")
+        self.assertEqual(code, 0)
+        self.assertDictEqual(json.loads(output),
+                             {"request": "sprints.rapidview", "status": 200, "elapsed": None,
+                              "body": {"host": "example.com"}})
+
+    def test_run_failures(self):
+        code, output = self.run_main("users.search_username", "users.missing", "sprints.rapidview")
+        self.assertEqual(code, 1)
+        self.assertEqual(output, "404 users.search_username\n200 sprints.rapidview\n")
+
+    def test_run_stdin(self):
+        stdin = sys.stdin
+        sys.stdin = io.StringIO("sprints.rapidview\n\n# comment\nsprints.rapidview\n")
+        try:
+            code, output = self.run_main()
+        finally:
+            sys.stdin = stdin
+        self.assertEqual(output, "200 sprints.rapidview\n" * 2)
+
+
+class TestRunAll(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = pmr.load_collection("../examples/JIRA.json.postman_collection")
+        self.env = pmr.O(rapidViewId="1")
+        self.order = []
+
+    def tearDown(self):
+        pmr.H.history = []
+
+    def set_middleware(self, **middlewares):
+        for name, runner in self.collection._runners():
+            runner.middlewares = pmr.O(**middlewares)
+
+    def respond(self, name, status=200):
+        self.order.append(name)
+        time.sleep(0.01)
+        return pmr.O(status_code=status)
+
+    def test_reads_writes(self):
+        self.assertEqual(pmr.get_request_reads(self.collection.sprints.sprint_issues.request),
+                         {"rapidViewId", "sprintID"})
+
+        def middleware(run, kwargs, env):
+            env.token = 1
+            env["other"] = 2
+            env.x.y = 3
+        self.assertEqual(pmr.get_middleware_writes(middleware), {"token", "other"})
+
+    def test_dependencies(self):
+        def sprints_rapidview(run, kwargs, env):
+            env.sprintID = "1"
+            return self.respond("rapidview")
+
+        self.set_middleware(sprints_rapidview=sprints_rapidview)
+        runners = self.collection._runners()
+        self.assertListEqual([name for name, _ in runners],
+                             ["sprints.rapidview", "sprints.sprint", "sprints.sprint_issues",
+                              "users.search_username"])
+        dependencies = pmr.get_dependencies(runners, depends={"users.search_username": ["sprints.sprint"]})
+        self.assertDictEqual(dependencies, {"sprints.rapidview": set(),
+                                            "sprints.sprint": set(),
+                                            "sprints.sprint_issues": {"sprints.rapidview"},
+                                            "users.search_username": {"sprints.sprint"}})
+
+    def test_run_all(self):
+        def sprints_rapidview(run, kwargs, env):
+            env.sprintID = "1"
+            return self.respond("rapidview")
+
+        self.set_middleware(sprints_rapidview=sprints_rapidview,
+                            sprints_sprint_issues=lambda run, kwargs, env: self.respond("sprint_issues"),
+                            sprints_sprint=lambda run, kwargs, env: self.respond("sprint", 500),
+                            users_search_username=lambda run, kwargs, env: self.respond("search_username"))
+        report = self.collection._run_all(env=self.env, depends={"users.search_username": ["sprints.sprint"]})
+
+        self.assertLess(self.order.index("rapidview"), self.order.index("sprint_issues"))
+        self.assertNotIn("search_username", self.order)
+        self.assertEqual((report.passed, report.failed, report.skipped), (2, 1, 1))
+        self.assertEqual([r.status for r in report.results], [200, 500, 200, None])
+        self.assertEqual(len(pmr.H.history), 3)
+        self.assertTrue(repr(report).startswith("Request"))
+
+    def test_run_all_unresolved(self):
+        self.set_middleware(sprints_sprint=lambda run, kwargs, env: self.respond("sprint"))
+        report = self.collection.sprints._run_all(env=self.env, depends={"sprints.sprint": ["missing"]})
+        self.assertEqual(report.skipped, 1)
+        self.assertEqual(report.results[1].error, "skipped")
+
+
+class TestIterate(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = pmr.load_collection("../examples/JIRA.json.postman_collection")
+        self.env = pmr.O(rapidViewId="1", sprintID="0")
+        self.dir = tempfile.mkdtemp()
+        self.release = threading.Event()
+        self.release.set()
+
+        def send(runner, kwargs, session):
+            self.release.wait()
+            return make_response(content=json.dumps({"params": kwargs["params"]}).encode("utf-8"))
+
+        self.send = pmr.HistoryRunner.send
+        pmr.HistoryRunner.send = send
+        self.level, pmr.LOG.level = pmr.LOG.level, "silent"
+
+    def tearDown(self):
+        pmr.HistoryRunner.send = self.send
+        pmr.LOG.level = self.level
+        pmr.H.history = []
+
+    def read_results(self, path):
+        with open(path) as f:
+            return sorted((json.loads(line) for line in f), key=lambda r: r["row"])
+
+    def test_data_rows(self):
+        csv_path = os.path.join(self.dir, "rows.csv")
+        with open(csv_path, "w") as f:
+            f.write("sprintID,name\n1,a\n2,\"b, c\"\n")
+        jsonl_path = os.path.join(self.dir, "rows.jsonl")
+        with open(jsonl_path, "w") as f:
+            f.write('{"sprintID": "1"}\n\n{"sprintID": "2"}\n')
+        json_path = os.path.join(self.dir, "rows.json")
+        with open(json_path, "w") as f:
+            f.write('[{"sprintID": "1"}, {"sprintID": "2"}]')
+
+        self.assertEqual(list(pmr.iter_data_rows(csv_path)), [{"sprintID": "1", "name": "a"},
+                                                              {"sprintID": "2", "name": "b, c"}])
+        self.assertEqual(list(pmr.iter_data_rows(jsonl_path)), [{"sprintID": "1"}, {"sprintID": "2"}])
+        self.assertEqual(list(pmr.iter_data_rows(json_path)), [{"sprintID": "1"}, {"sprintID": "2"}])
+
+    def test_iterate(self):
+        runner = self.collection.sprints.sprint_issues
+        rows = ({"sprintID": str(i)} for i in range(50))
+        output = os.path.join(self.dir, "out.jsonl")
+        report = runner._iterate(rows, sink=output, fields=["params.sprintId", "params.missing"], env=self.env)
+
+        self.assertEqual((report.rows, report.passed, report.failed), (50, 50, 0))
+        self.assertEqual(report.statuses, {200: 50})
+        results = self.read_results(output)
+        self.assertEqual([r["params.sprintId"] for r in results], [str(i) for i in range(50)])
+        self.assertTrue(all(r["status"] == 200 and r["total_ms"] > 0 and r["params.missing"] is None
+                            for r in results))
+        self.assertEqual(pmr.H.history, [])
+        self.assertEqual(self.env.sprintID, "0")
+
+    def test_csv_sink(self):
+        runner = self.collection.sprints.sprint_issues
+        output = os.path.join(self.dir, "out.csv")
+        runner._iterate([{"sprintID": "1"}], sink=output, fields=["params"], env=self.env)
+        with open(output) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(rows[0]["status"], "200")
+        self.assertEqual(json.loads(rows[0]["params"]), {"rapidViewId": "1", "sprintId": "1"})
+
+    def test_errors(self):
+        def sprints_sprint_issues(run, kwargs, env):
+            if env.sprintID == "1":
+                raise ValueError("bad row")
+            return run(kwargs)
+
+        runner = self.collection.sprints.sprint_issues
+        output = os.path.join(self.dir, "out.jsonl")
+        report = runner._iterate([{"sprintID": "0"}, {"sprintID": "1"}], sink=output, env=self.env,
+                                 middlewares=pmr.O(sprints_sprint_issues=sprints_sprint_issues))
+        self.assertEqual((report.passed, report.failed), (1, 1))
+        self.assertEqual(self.read_results(output)[1]["error"], "ValueError: bad row")
+
+    def test_bad_data_file(self):
+        runner = self.collection.sprints.sprint_issues
+        data_path = os.path.join(self.dir, "rows.json")
+        with open(data_path, "w") as f:
+            f.write('[{"sprintID": "1"}, {"sprintID": "2"}, {"sprintID": ')
+        output = os.path.join(self.dir, "out.jsonl")
+        with self.assertRaises(ValueError):
+            runner._iterate(pmr.iter_data_rows(data_path), sink=output, env=self.env)
+        self.assertEqual([r["status"] for r in self.read_results(output)], [200, 200])
+
+    def test_backpressure(self):
+        taken = []
+
+        def rows():
+            for i in range(100):
+                taken.append(i)
+                yield {"sprintID": str(i)}
+
+        self.release.clear()
+        thread = threading.Thread(target=self.collection.sprints.sprint_issues._iterate,
+                                  args=(rows(),), kwargs={"concurrency": 2, "env": self.env})
+        thread.start()
+        time.sleep(0.1)
+        self.assertLessEqual(len(taken), 5)
+        self.release.set()
+        thread.join()
+        self.assertEqual(len(taken), 100)
+
+
 class TestPostmanRepl(unittest.TestCase):
 
     def setUp(self):
@@ -104,6 +1244,140 @@ class TestPostmanRepl(unittest.TestCase):
         self.assertTrue("META" in self.collection["users"])
         self.assertTrue("search_username" in self.collection["users"])
 
+    def test_load_collection_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        path = os.path.join(cache_dir, "collection.json")
+        with open(self.coll_file) as src, open(path, "w") as dest:
+            dest.write(src.read())
+
+        collection = pmr.load_collection(path, cache_dir=cache_dir)
+        self.assertTrue("sprint" in collection["sprints"])
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+        with open(path) as f:
+            coll = json.load(f)
+        coll["folders"][0]["name"] = "Changed"
+        with open(path, "w") as f:
+            json.dump(coll, f)
+        collection = pmr.load_collection(path, cache_dir=cache_dir)
+        self.assertTrue("changed" in collection)
+        self.assertFalse("sprints" in collection)
+
+    def test_load_cached_json(self):
+        cache_dir = tempfile.mkdtemp()
+        path = os.path.join(cache_dir, "data.json")
+        with open(path, "w") as f:
+            f.write('{"a": 1}')
+        stat = os.stat(path)
+        self.assertDictEqual(pmr.load_cached_json(path, cache_dir), {"a": 1})
+
+        # Same mtime and size is trusted without reading the file
+        with open(path, "w") as f:
+            f.write('{"a": 2}')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertDictEqual(pmr.load_cached_json(path, cache_dir), {"a": 1})
+
+        os.utime(path, (0, 0))
+        self.assertDictEqual(pmr.load_cached_json(path, cache_dir), {"a": 2})
+
+    def test_load_json_stream(self):
+        doc = {"a": [1, 2.5, "x\\\"y", None, {"response": [{"b": "}]"}], "c": True}], "response": "skipped", "ü": {}}
+        text = json.dumps(doc, ensure_ascii=False)
+        for chunk_size in (1, 7, 65536):
+            self.assertEqual(pmr.load_json_stream(io.StringIO(text), chunk_size=chunk_size), doc)
+            self.assertEqual(pmr.load_json_stream(io.BytesIO(text.encode("utf-8")), skip=["response"],
+                                                  chunk_size=chunk_size),
+                             {"a": [1, 2.5, "x\\\"y", None, {"c": True}], "ü": {}})
+        for bad in ('{"a": 1', '[1, 2] 3', '{"a" 1}'):
+            self.assertRaises(ValueError, pmr.load_json_stream, io.StringIO(bad))
+
+    def test_load_json_stream_skip_long_string(self):
+        import tracemalloc
+        # 7MB of escapes, so that chunks end partway through them
+        text = json.dumps({"response": "ab\\\"c" * (1024 * 1024), "a": 1}).encode("utf-8")
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            self.assertEqual(pmr.load_json_stream(io.BytesIO(text), skip=["response"], chunk_size=1000), {"a": 1})
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 1024 * 1024)
+        self.assertLess(elapsed, 10)
+
+    def test_load_collection_v2(self):
+        auth = {"type": "basic", "basic": [{"key": "username", "value": "{{user}}"},
+                                           {"key": "password", "value": "secret"}]}
+        example = {"name": "Example", "body": "x" * 100000, "header": [{"key": "response", "value": "1"}]}
+        coll = {
+            "info": {"name": "V2", "schema": "https://schema.getpostman.com/json/collection/v2.1.0/collection.json"},
+            "item": [
+                {"name": "Users", "item": [
+                    {"name": "Admin Users", "item": [
+                        {"name": "Get Admin", "id": "get-admin",
+                         "request": {"method": "POST",
+                                     "url": {"raw": "https://{{host}}/admins?page=1", "host": ["{{host}}"]},
+                                     "header": [{"key": "Accept", "value": "application/json"},
+                                                {"key": "X-Off", "value": "1", "disabled": True}],
+                                     "body": {"mode": "raw", "raw": '{"id": 1}'},
+                                     "description": {"content": "Gets an admin"}},
+                         "response": [example] * 20},
+                    ]},
+                    {"name": "List", "request": {"url": "https://{{host}}/users", "auth": {"type": "noauth"}},
+                     "response": []},
+                ]},
+                {"name": "Ping", "request": "https://{{host}}/ping"},
+            ],
+            "auth": auth,
+        }
+        path = os.path.join(tempfile.mkdtemp(), "v2.json")
+        with open(path, "w") as f:
+            json.dump(coll, f)
+
+        collection = pmr.load_collection(path)
+        runner = collection["users"]["admin_users"]["get_admin"]
+        self.assertEqual(runner.request["url"], "https://{{host}}/admins?page=1")
+        self.assertEqual(runner.request["headers"], "Accept: application/json\n")
+        self.assertEqual(runner.request["description"], "Gets an admin")
+        self.assertFalse("response" in runner.request)
+        self.assertEqual(runner.request["id"], "get-admin")
+        self.assertEqual([name for name, _ in collection._runners()],
+                         ["users.admin_users.get_admin", "users.list", "ping"])
+
+        prepared = runner.prepare(pmr.O(host="example.com", user="me"))
+        self.assertEqual(prepared.url, "https://example.com/admins")
+        self.assertEqual(prepared.kwargs["params"], {"page": "1"})
+        self.assertEqual(prepared.kwargs["data"], '{"id": 1}')
+        self.assertEqual(prepared.auth._to_dict(), {"type": "basicAuth", "username": "me", "password": "secret"})
+        self.assertIsNone(collection["users"]["list"].prepare(pmr.O(host="example.com")).auth)
+        self.assertEqual(collection["ping"].request["method"], "GET")
+
+    def test_lazy_docstring(self):
+        runner = self.collection["sprints"]["sprint"]
+        self.assertFalse("__doc__" in runner.__dict__)
+        self.assertTrue(runner.__doc__.startswith("Sprints / Sprint:"))
+        self.assertTrue(pmr.Runner.__doc__.strip().startswith("Holds the state"))
+
+    def test_request_plan(self):
+        runner = self.collection["sprints"]["sprint"]
+        env = self.env._copy()
+        expected = {}
+        url, _, expected = pmr.set_url(runner.request, pmr.set_headers(runner.request, expected, env=env), env=env)
+        expected = pmr.set_body(runner.request, expected, env=env)
+
+        first = runner.prepare(env)
+        self.assertEqual(first.url, url)
+        self.assertDictEqual(first.kwargs, expected)
+        self.assertDictEqual(first.auth._to_dict(), pmr.get_auth(runner.request, env=env)._to_dict())
+
+        plan = runner.plan
+        self.assertIs(runner.add_params(a="b").plan, plan)
+        env.password = "changed"
+        second = runner.prepare(env)
+        self.assertTrue('"changed"' in second.kwargs["data"])
+        self.assertEqual(second.url, url)
+
     def test_load_environment(self):
 
         self.assertDictEqual(self.env._to_dict_recursive(), {
@@ -169,6 +1443,20 @@ class TestPostmanRepl(unittest.TestCase):
         pmr.H(0)
         self.assertTrue(all(called))
 
+    def test_map(self):
+        def middleware(run, kwargs, env):
+            time.sleep(0.01 * (5 - int(kwargs["params"]["i"])))
+            return kwargs["params"]["i"]
+
+        middlewares = pmr.O(sprints_rapidview=middleware)
+        kwargs_list = [{'params': {'i': str(i)}} for i in range(5)]
+        results = self.collection["sprints"]["rapidview"]._map(kwargs_list, concurrency=5,
+                                                               env=self.env, middlewares=middlewares)
+        self.assertListEqual(results, ['0', '1', '2', '3', '4'])
+        self.assertEqual(len(pmr.H.history), 5)
+        # The calls finish in reverse, the history is still in the order of kwargs_list
+        self.assertListEqual([item.kwargs["params"]["i"] for item in pmr.H.history], ['0', '1', '2', '3', '4'])
+
     def test_help(self):
         expect = """Sprints / Sprint:
 GET https://unified.jira.com/rest/greenhopper/latest/sprintquery/{{rapidViewId}}?includeHistoricSprints=true&includeFutureSprints=true
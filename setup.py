@@ -79,6 +79,7 @@ setup(
     # for example:
     # $ pip install -e .[dev,test]
     extras_require={
+        'async': ['httpx'],
     },
 
     # If there are data files included in your packages that need to be